@@ -1,7 +1,22 @@
 import os
 import logging
 import uuid
+import functools
 import asyncio
+import signal
+import sqlite3
+import time
+import heapq
+import itertools
+import weakref
+import json
+import random
+import secrets
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import struct
+import zlib
+import base64
 from datetime import datetime, timedelta
 from telegram import (
     Update,
@@ -9,7 +24,11 @@ from telegram import (
     InlineKeyboardMarkup,
     Message,
     Bot,
-    constants
+    constants,
+    InputMediaPhoto,
+    InputMediaVideo,
+    InputMediaDocument,
+    InputMediaAudio
 )
 from telegram.ext import (
     Application,
@@ -18,8 +37,11 @@ from telegram.ext import (
     CallbackQueryHandler,
     ContextTypes,
     filters,
-    ConversationHandler
+    ConversationHandler,
+    BaseUpdateProcessor
 )
+from telegram.error import RetryAfter, TimedOut, NetworkError, BadRequest, Forbidden, TelegramError
+from telegram.request import BaseRequest
 from dotenv import load_dotenv
 import aiohttp
 from aiohttp import web
@@ -29,7 +51,41 @@ load_dotenv()
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 ADMIN_IDS = [int(id) for id in os.getenv('ADMIN_IDS', '').split(',') if id]
 STORAGE_CHANNELS = [chan.strip() for chan in os.getenv('STORAGE_CHANNELS', '').split(',') if chan.strip()]
+# کانال‌های عضویت اجباری: @username یا chat_id|invite_link
+REQUIRED_CHANNELS = [chan.strip() for chan in os.getenv('REQUIRED_CHANNELS', '').split(',') if chan.strip()]
 DEFAULT_TIMER = int(os.getenv('DEFAULT_TIMER', 3600))  # زمان پیش‌فرض: 1 ساعت
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'channel')  # channel یا sqlite
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'bot_data.db')
+STORAGE_MIRROR = os.getenv('STORAGE_MIRROR', '1') == '1'  # پشتیبان‌گیری در کانال‌ها در حالت sqlite
+STORAGE_ENCODING = os.getenv('STORAGE_ENCODING', 'compact')  # compact یا text (قالب قدیمی)
+STORAGE_FLUSH_WINDOW = float(os.getenv('STORAGE_FLUSH_WINDOW', 3))  # حداقل فاصله ویرایش هر پیام ذخیره‌سازی به ثانیه (0 = نوشتن فوری)
+SHARD_RETRY_TTL = int(os.getenv('SHARD_RETRY_TTL', 300))  # فاصله تلاش دوباره shardهای دریافت نشده (ثانیه)
+GLOBAL_SEND_RATE = float(os.getenv('GLOBAL_SEND_RATE', 30))  # پیام در ثانیه برای کل ربات
+CHAT_SEND_RATE = float(os.getenv('CHAT_SEND_RATE', 2))  # پیام در ثانیه برای هر چت
+CHAT_SEND_BURST = float(os.getenv('CHAT_SEND_BURST', 10))  # حداکثر ارسال پشت سر هم در هر چت
+ALBUM_MODE = os.getenv('ALBUM_MODE', '0') == '1'  # ارسال فایل‌ها به صورت آلبوم (sendMediaGroup)
+DELETION_DB = os.getenv('DELETION_DB', SQLITE_PATH)  # ذخیره پایدار حذف‌های در انتظار (خالی = غیرفعال)
+SCAN_STATE_DB = os.getenv('SCAN_STATE_DB', SQLITE_PATH)  # نسخه محلی پیام‌های ذخیره‌سازی و آخرین پیام خوانده شده هر کانال (خالی = پیمایش کامل؛ فقط با کلاینت دارای get_chat_history)
+DELETE_CONCURRENCY = int(os.getenv('DELETE_CONCURRENCY', 10))  # حداکثر حذف‌های همزمان
+DELETE_RETRY_MAX = int(os.getenv('DELETE_RETRY_MAX', 900))  # سقف فاصله تلاش دوباره حذف‌های ناموفق (ثانیه)
+COUNTDOWN_MODE = os.getenv('COUNTDOWN_MODE', 'adaptive')  # adaptive یا static (فقط زمان حذف، بدون ویرایش)
+COUNTDOWN_EDIT_RATE = float(os.getenv('COUNTDOWN_EDIT_RATE', 5))  # سقف ویرایش شمارش معکوس در ثانیه برای کل ربات
+MEMBERSHIP_CACHE_SIZE = int(os.getenv('MEMBERSHIP_CACHE_SIZE', 50000))
+MEMBERSHIP_TTL = int(os.getenv('MEMBERSHIP_TTL', 600))  # اعتبار نتیجه «عضو است»
+MEMBERSHIP_NEGATIVE_TTL = int(os.getenv('MEMBERSHIP_NEGATIVE_TTL', 30))  # اعتبار نتیجه «عضو نیست»
+SESSION_TTL = int(os.getenv('SESSION_TTL', 3600))  # ثانیه بیکاری تا حذف جلسه آپلود/تایمر/کانال
+SESSION_MAX = int(os.getenv('SESSION_MAX', 1000))  # حداکثر جلسه‌های همزمان در حافظه
+SESSION_MAX_FILES = int(os.getenv('SESSION_MAX_FILES', 500))  # حداکثر فایل در یک جلسه آپلود
+SESSION_DB = os.getenv('SESSION_DB', SQLITE_PATH)  # ذخیره پایدار جلسه‌ها (خالی = غیرفعال)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # آدرس عمومی سرور؛ خالی = حالت polling
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram-webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', 64))  # حداکثر آپدیت‌های همزمان
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 256))  # اندازه استخر اتصال HTTP مشترک
+HTTP_KEEPALIVE = float(os.getenv('HTTP_KEEPALIVE', 60))  # ثانیه نگه‌داری اتصال بیکار
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 10))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 30))
+KEEP_ALIVE_URL = os.getenv('KEEP_ALIVE_URL', 'https://improved-robot-production.up.railway.app/health')
 
 # تنظیمات لاگ
 logging.basicConfig(
@@ -41,355 +97,2215 @@ logger = logging.getLogger(__name__)
 # حالت‌های گفتگو
 UPLOADING, WAITING_CHANNEL_INFO, WAITING_TIMER, WAITING_CATEGORY_TIMER = range(4)
 
-class ChannelStorage:
+# متد ارسال هر نوع فایل
+SEND_METHODS = {
+    'document': 'send_document',
+    'photo': 'send_photo',
+    'video': 'send_video',
+    'audio': 'send_audio'
+}
+
+# نوع رسانه آلبوم و گروه سازگار هر نوع فایل (عکس و ویدیو قابل ترکیب هستند)
+INPUT_MEDIA = {
+    'photo': (InputMediaPhoto, 'visual'),
+    'video': (InputMediaVideo, 'visual'),
+    'document': (InputMediaDocument, 'document'),
+    'audio': (InputMediaAudio, 'audio')
+}
+MEDIA_GROUP_LIMIT = 10
+
+# متدهای ذخیره‌سازی که زمان اجرایشان در /metrics گزارش می‌شود
+STORAGE_METHODS = [
+    'initialize', 'save_global_timer', 'save_category_timer', 'add_category', 'get_categories',
+    'get_category', 'add_file', 'add_files', 'delete_category', 'save_required_channels'
+]
+
+class Metrics:
+    """شمارنده، gauge و هیستوگرام ساده با خروجی متنی Prometheus"""
+    
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    
+    def __init__(self):
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+        self.gauges = {}  # name -> callable
+        self.help = {}
+    
+    @staticmethod
+    def _labels(labels: dict) -> tuple:
+        return tuple(sorted((key, str(value)) for key, value in labels.items()))
+    
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, self._labels(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+    
+    def observe(self, name: str, value: float, **labels):
+        key = (name, self._labels(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+    
+    def gauge(self, name: str, func, description: str = ''):
+        self.gauges[name] = func
+        self.help[name] = description
+    
+    def instrument(self, obj, methods: list, name: str, **labels):
+        """اندازه‌گیری زمان متدهای async یک شیء"""
+        for method in methods:
+            original = getattr(obj, method, None)
+            if original is None:
+                continue
+            setattr(obj, method, self._timed(original, name, dict(labels, method=method)))
+    
+    def _timed(self, func, name: str, labels: dict):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                self.observe(name, time.perf_counter() - started, **labels)
+        return wrapper
+    
+    def track_handler(self, func):
+        """دکوراتور زمان‌سنجی هندلرها"""
+        return self._timed(func, 'handler_duration_seconds', {'handler': func.__name__})
+    
+    @staticmethod
+    def _escape(value: str) -> str:
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    
+    @classmethod
+    def _format_labels(cls, labels, extra: tuple = ()) -> str:
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        return '{' + ','.join(f'{key}="{cls._escape(value)}"' for key, value in items) + '}'
+    
+    def render(self) -> str:
+        lines = []
+        seen = set()
+        for (name, labels), value in sorted(self.counters.items()):
+            if name not in seen:
+                lines.append(f"# TYPE {name} counter")
+                seen.add(name)
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in sorted(self.histograms.items()):
+            if name not in seen:
+                lines.append(f"# TYPE {name} histogram")
+                seen.add(name)
+            for bound, bucket_count in zip(self.BUCKETS, buckets):
+                lines.append(f"{name}_bucket{self._format_labels(labels, (('le', str(bound)),))} {bucket_count}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+        for name, func in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logger.warning(f"خطا در محاسبه {name}: {e}")
+                continue
+            if self.help.get(name):
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+class CompactCodec:
+    """رمزگذاری فشرده نسخه‌دار برای پیام‌های ذخیره‌سازی
+    
+    ساختار: جدول نوع فایل‌ها و جدول کپشن‌های یکتا، سپس رکورد دسته‌ها با
+    ارجاع عددی به این جدول‌ها و در انتها (اختیاری) ارجاع به پیام‌های ادامه
+    (shard) هر دسته. کل داده با zlib فشرده و با base85 متنی می‌شود.
+    """
+    
+    VERSION = 'v2'
+    
+    @staticmethod
+    def _pack_str(buf: bytearray, value: str):
+        data = value.encode('utf-8')
+        buf += struct.pack('>H', len(data))
+        buf += data
+    
+    @staticmethod
+    def _unpack_str(data: bytes, offset: int):
+        (length,) = struct.unpack_from('>H', data, offset)
+        offset += 2
+        return data[offset:offset + length].decode('utf-8'), offset + length
+    
+    @classmethod
+    def encode(cls, records: list) -> str:
+        """تبدیل رکوردها به متن فشرده"""
+        file_types = []
+        captions = ['']
+        type_index = {}
+        caption_index = {'': 0}
+        for record in records:
+            for file in record['files']:
+                if file['file_type'] not in type_index:
+                    type_index[file['file_type']] = len(file_types)
+                    file_types.append(file['file_type'])
+                caption = file.get('caption', '')
+                if caption not in caption_index:
+                    caption_index[caption] = len(captions)
+                    captions.append(caption)
+        
+        buf = bytearray()
+        buf += struct.pack('>B', len(file_types))
+        for file_type in file_types:
+            cls._pack_str(buf, file_type)
+        buf += struct.pack('>H', len(captions))
+        for caption in captions:
+            cls._pack_str(buf, caption)
+        buf += struct.pack('>H', len(records))
+        for record in records:
+            cls._pack_str(buf, record['id'])
+            cls._pack_str(buf, record['name'])
+            cls._pack_str(buf, str(record['created_by'] or ''))
+            timer = record['timer']
+            buf += struct.pack('>iH', -1 if timer is None else timer, len(record['files']))
+            for file in record['files']:
+                cls._pack_str(buf, file['file_id'])
+                buf += struct.pack('>BH', type_index[file['file_type']], caption_index[file.get('caption', '')])
+        # بخش انتهایی: ارجاع به shardها
+        for record in records:
+            shards = record.get('shards', [])
+            buf += struct.pack('>H', len(shards))
+            for channel, message_id in shards:
+                cls._pack_str(buf, str(channel))
+                buf += struct.pack('>q', message_id)
+        return base64.b85encode(zlib.compress(bytes(buf), 9)).decode('ascii')
+    
+    @classmethod
+    def decode(cls, text: str) -> list:
+        """تبدیل متن فشرده به رکوردها"""
+        data = zlib.decompress(base64.b85decode(text.strip()))
+        offset = 0
+        
+        (type_count,) = struct.unpack_from('>B', data, offset)
+        offset += 1
+        file_types = []
+        for _ in range(type_count):
+            value, offset = cls._unpack_str(data, offset)
+            file_types.append(value)
+        
+        (caption_count,) = struct.unpack_from('>H', data, offset)
+        offset += 2
+        captions = []
+        for _ in range(caption_count):
+            value, offset = cls._unpack_str(data, offset)
+            captions.append(value)
+        
+        (record_count,) = struct.unpack_from('>H', data, offset)
+        offset += 2
+        records = []
+        for _ in range(record_count):
+            category_id, offset = cls._unpack_str(data, offset)
+            name, offset = cls._unpack_str(data, offset)
+            created_by, offset = cls._unpack_str(data, offset)
+            timer, file_count = struct.unpack_from('>iH', data, offset)
+            offset += 6
+            files = []
+            for _ in range(file_count):
+                file_id, offset = cls._unpack_str(data, offset)
+                type_code, caption_code = struct.unpack_from('>BH', data, offset)
+                offset += 3
+                files.append({
+                    'file_id': file_id,
+                    'file_type': file_types[type_code],
+                    'caption': captions[caption_code]
+                })
+            records.append({
+                'id': category_id,
+                'name': name,
+                'created_by': created_by or None,
+                'timer': None if timer < 0 else timer,
+                'files': files,
+                'shards': []
+            })
+        
+        # پیام‌های قدیمی‌تر v2 بخش shard ندارند
+        if offset < len(data):
+            for record in records:
+                (shard_count,) = struct.unpack_from('>H', data, offset)
+                offset += 2
+                for _ in range(shard_count):
+                    channel, offset = cls._unpack_str(data, offset)
+                    (message_id,) = struct.unpack_from('>q', data, offset)
+                    offset += 8
+                    record['shards'].append((channel, message_id))
+        return records
+
+class StorageBackend(ABC):
+    """رابط مشترک لایه‌های ذخیره‌سازی"""
+    
+    def __init__(self):
+        self.global_timer = DEFAULT_TIMER
+        self.category_timers = {}  # category_id -> ثانیه
+        self.required_channels = []
+        self.listeners = ()
+    
+    @abstractmethod
+    async def initialize(self):
+        ...
+    
+    def get_category_timer(self, category_id: str) -> int:
+        """تایمر اختصاصی دسته یا تایمر جهانی"""
+        return self.category_timers.get(category_id, self.global_timer)
+    
+    @abstractmethod
+    async def save_global_timer(self, seconds: int):
+        ...
+    
+    @abstractmethod
+    async def save_category_timer(self, category_id: str, seconds: int):
+        ...
+    
+    @abstractmethod
+    async def add_category(self, name: str, created_by: int, category_id: str = None) -> str:
+        ...
+    
+    @abstractmethod
+    async def get_categories(self) -> dict:
+        ...
+    
+    @abstractmethod
+    async def get_category(self, category_id: str) -> dict:
+        ...
+    
+    @abstractmethod
+    async def add_file(self, category_id: str, file_info: dict) -> bool:
+        ...
+    
+    async def add_files(self, category_id: str, files: list) -> list:
+        """افزودن گروهی فایل‌ها؛ نتیجه هر فایل به ترتیب ورودی"""
+        return [await self.add_file(category_id, file_info) for file_info in files]
+    
+    @abstractmethod
+    async def delete_category(self, category_id: str) -> bool:
+        ...
+    
+    @abstractmethod
+    async def save_required_channels(self, channels: list):
+        ...
+    
+    async def sync(self):
+        """نوشتن تغییرات بافر شده؛ (تعداد نوشته شده, تعداد ناموفق)"""
+        return 0, 0
+    
+    def add_listener(self, callback):
+        """ثبت تابعی که پس از تغییر یک دسته با category_id (None = همه دسته‌ها) صدا زده می‌شود"""
+        self.listeners = self.listeners + (callback,)
+    
+    def _notify(self, category_id: str = None):
+        for callback in self.listeners:
+            callback(category_id)
+
+class HistorySnapshot:
+    """نسخه محلی پیام‌های ذخیره‌سازی و آخرین پیام پیمایش شده هر کانال در SQLite"""
+    
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS storage_messages (
+                channel TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (channel, message_id)
+            );
+            CREATE TABLE IF NOT EXISTS scan_state (
+                channel TEXT PRIMARY KEY,
+                high_water_mark INTEGER NOT NULL
+            );
+        """)
+        self.conn.commit()
+    
+    def load(self, channel) -> tuple:
+        """(آخرین پیام پیمایش شده, {message_id: text})"""
+        row = self.conn.execute(
+            "SELECT high_water_mark FROM scan_state WHERE channel = ?", (str(channel),)).fetchone()
+        messages = dict(self.conn.execute(
+            "SELECT message_id, text FROM storage_messages WHERE channel = ?", (str(channel),)))
+        return (row[0] if row else 0), messages
+    
+    def save(self, channel, messages: dict, high_water_mark: int):
+        """ثبت پیام‌های پیمایش شده جدید همراه با آخرین شناسه"""
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO storage_messages (channel, message_id, text) VALUES (?, ?, ?)",
+                [(str(channel), message_id, text) for message_id, text in messages.items()]
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO scan_state (channel, high_water_mark) VALUES (?, ?)",
+                (str(channel), high_water_mark)
+            )
+    
+    def put(self, channel, message_id: int, text: str):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO storage_messages (channel, message_id, text) VALUES (?, ?, ?)",
+                (str(channel), message_id, text)
+            )
+    
+    def remove(self, channel, message_id: int):
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM storage_messages WHERE channel = ? AND message_id = ?", (str(channel), message_id))
+
+class ChannelStorage(StorageBackend):
     """سیستم ذخیره‌سازی بهینه‌شده در کانال تلگرام"""
     
-    def __init__(self, bot):
+    def __init__(self, bot, snapshot: 'HistorySnapshot' = None):
+        super().__init__()
         self.bot = bot
+        self.snapshot = snapshot
         self.channels = STORAGE_CHANNELS
         self.categories_per_message = 10
-        self.global_timer = DEFAULT_TIMER
-        self.category_timers = {}
-        self.current_channel_index = 0
+        # ایندکس دسته‌ها: category_id -> (channel, message_id, record)
         self.message_cache = {}
+        # ترتیب دسته‌ها در هر پیام: (channel, message_id) -> [category_id, ...]
+        self.blocks = {}
+        # پیام‌های ادامه دسته‌های بزرگ: (channel, message_id) -> shard record
+        self.shards = {}
+        self.shard_fetches = {}  # (channel, message_id) -> وظیفه دریافت در جریان
+        self.shard_failures = {}  # (channel, message_id) -> زمان آخرین دریافت ناموفق (monotonic)
+        self.global_timer_message = None
+        self.required_channels_message = None
+        # هماهنگی نوشتن: قفل هر دسته و هر پیام، نسخه تغییر در حافظه و نسخه نوشته شده هر پیام
+        self.category_locks = weakref.WeakValueDictionary()
+        self.message_locks = weakref.WeakValueDictionary()
+        self.versions = {}  # (channel, message_id) -> نسخه حافظه
+        self.written = {}  # (channel, message_id) -> آخرین نسخه ویرایش شده در تلگرام
+        self.written_texts = {}  # (channel, message_id) -> متن فعلی پیام در تلگرام
+        # نوشتن با تاخیر: هر پیام حداکثر یک ویرایش در هر پنجره
+        self.flush_window = STORAGE_FLUSH_WINDOW
+        self.last_flush = {}  # (channel, message_id) -> زمان آخرین ویرایش (monotonic)
+        self.flush_tasks = {}  # (channel, message_id) -> وظیفه flush زمان‌بندی شده
         self.loaded = False
     
     async def initialize(self):
-        """بارگذاری اولیه داده‌ها"""
+        """بارگذاری اولیه داده‌ها با یک پیمایش همزمان همه کانال‌ها"""
         if self.loaded:
             return
-            
-        # بارگذاری تایمر جهانی
-        await self.load_global_timer()
         
-        # بارگذاری تایمرهای اختصاصی دسته‌ها
-        await self.load_category_timers()
+        started = time.perf_counter()
+        if not hasattr(self.bot, 'get_chat_history'):
+            # Bot API تاریخچه کانال را برنمی‌گرداند؛ فقط پیام‌هایی که این ربات نوشته و در نسخه محلی ثبت شده‌اند دیده می‌شوند
+            if not self.snapshot:
+                raise RuntimeError(
+                    "کلاینت ربات get_chat_history ندارد و SCAN_STATE_DB خالی است؛ داده‌های کانال ذخیره‌سازی قابل بارگذاری نیست")
+            logger.warning(
+                "کلاینت ربات get_chat_history ندارد؛ نسخه محلی SCAN_STATE_DB تنها منبع داده‌های کانال ذخیره‌سازی است "
+                "و پیام‌هایی که در آن ثبت نشده‌اند بارگذاری نمی‌شوند")
+        histories = await asyncio.gather(*(self._scan_channel(channel) for channel in self.channels))
+        
+        # اعمال به ترتیب کانال‌ها؛ در هر کانال از جدید به قدیم
+        scanned = 0
+        for channel, messages in zip(self.channels, histories):
+            scanned += len(messages)
+            for message_id, text in messages:
+                self._index_message(channel, message_id, text)
+        
+        # shardهایی که در پیمایش دیده نشدند یک بار همین‌جا دریافت می‌شوند (فوروارد فقط در بارگذاری، نه با کلیک کاربران)
+        refs = [ref for entry in self.message_cache.values() for ref in entry[2]['shards']]
+        if not await self._load_shards(refs, forward=True):
+            logger.error("بعضی shardها دریافت نشدند؛ دسته‌های مربوط ناقص ارسال می‌شوند")
         
         self.loaded = True
-        logger.info("Storage initialized")
+        logger.info(
+            f"Storage initialized in {time.perf_counter() - started:.2f}s "
+            f"({len(self.message_cache)} categories, {len(self.shards)} shards, "
+            f"{scanned} storage messages from {len(self.channels)} channels)"
+        )
     
-    async def load_global_timer(self):
-        """بارگذاری تایمر جهانی از کانال ذخیره‌سازی"""
-        for channel in self.channels:
+    async def _scan_channel(self, channel) -> list:
+        """پیام‌های ذخیره‌سازی یک کانال از جدید به قدیم: [(message_id, text), ...]
+
+        فقط پیام‌های جدیدتر از آخرین پیام خوانده شده پیمایش می‌شوند؛ بقیه از نسخه محلی می‌آیند.
+        """
+        hwm, known = 0, {}
+        if self.snapshot:
             try:
-                # دریافت تاریخچه چت با استفاده از روش صحیح PTB
-                messages = []
-                async for message in self.bot.get_chat_history(chat_id=channel, limit=100):
-                    if message.text and "===== GLOBAL TIMER =====" in message.text:
-                        try:
-                            self.global_timer = int(message.text.split('\n')[1])
-                            return
-                        except (IndexError, ValueError):
-                            pass
-            except Exception as e:
-                logger.error(f"خطا در بارگذاری تایمر جهانی: {e}")
+                hwm, known = self.snapshot.load(channel)
+            except sqlite3.Error as e:
+                logger.error(f"خطا در خواندن نسخه محلی کانال {channel}: {e}")
+        
+        new_messages = {}
+        newest = hwm
+        if not hasattr(self.bot, 'get_chat_history'):
+            return sorted(known.items(), reverse=True)
+        try:
+            async for message in self.bot.get_chat_history(chat_id=channel):
+                if message.message_id <= hwm:
+                    break
+                newest = max(newest, message.message_id)
+                if message.text and self._is_storage_text(message.text):
+                    new_messages[message.message_id] = message.text
+        except Exception as e:
+            logger.error(f"خطا در پیمایش کانال ذخیره‌سازی {channel}: {e}")
+            # بدون ثبت آخرین پیام تا پیمایش بعدی از همین نقطه ادامه دهد
+            newest = hwm
+        
+        if self.snapshot and (new_messages or newest > hwm):
+            try:
+                self.snapshot.save(channel, new_messages, newest)
+            except sqlite3.Error as e:
+                logger.error(f"خطا در ذخیره نسخه محلی کانال {channel}: {e}")
+        
+        known.update(new_messages)
+        return sorted(known.items(), reverse=True)
     
-    async def load_category_timers(self):
-        """بارگذاری تایمرهای اختصاصی دسته‌ها"""
-        for channel in self.channels:
+    @staticmethod
+    def _is_storage_text(text: str) -> bool:
+        return (
+            text.startswith(("CATEGORIES_BLOCK:", "CATEGORY_SHARD:", "===== REQUIRED CHANNELS ====="))
+            or "===== GLOBAL TIMER =====" in text
+            or "===== META =====" in text
+        )
+    
+    def _index_message(self, channel, message_id: int, text: str):
+        """تشخیص نوع پیام ذخیره‌سازی و افزودن آن به ساختارهای حافظه"""
+        if text.startswith(("CATEGORIES_BLOCK:", "CATEGORY_SHARD:", "===== REQUIRED CHANNELS =====")):
+            self.written_texts[(channel, message_id)] = text
+        if text.startswith("CATEGORIES_BLOCK:"):
+            self._index_block(channel, message_id, text)
+        elif text.startswith("CATEGORY_SHARD:"):
+            self._index_shard(channel, message_id, text)
+        elif text.startswith("===== REQUIRED CHANNELS ====="):
+            self._index_required_channels(channel, message_id, text)
+        elif "===== GLOBAL TIMER =====" in text:
+            # فقط جدیدترین تایمر معتبر است
+            if self.global_timer_message:
+                return
             try:
-                # دریافت تاریخچه چت با استفاده از روش صحیح PTB
-                async for message in self.bot.get_chat_history(chat_id=channel, limit=100):
-                    if message.text and "===== META =====" in message.text:
-                        lines = message.text.split('\n')
-                        category_id = None
-                        
-                        for line in lines:
-                            if line.startswith("CATEGORY:"):
-                                category_id = line.split(':')[1]
-                            elif line.startswith("TIMER:") and category_id:
-                                try:
-                                    self.category_timers[category_id] = int(line.split(':')[1])
-                                except ValueError:
-                                    pass
-            except Exception as e:
-                logger.error(f"خطا در بارگذاری تایمرهای دسته: {e}")
+                self.global_timer = int(text.split('\n')[1])
+                self.global_timer_message = (channel, message_id)
+            except (IndexError, ValueError):
+                pass
+        elif "===== META =====" in text:
+            # تایمر قالب قدیمی؛ تایمر ثبت شده در CATEGORIES_BLOCK اولویت دارد
+            category_id = None
+            for line in text.split('\n'):
+                if line.startswith("CATEGORY:"):
+                    category_id = line.split(':')[1]
+                elif line.startswith("TIMER:") and category_id:
+                    try:
+                        timer = int(line.split(':')[1])
+                    except ValueError:
+                        continue
+                    if category_id not in self.message_cache:
+                        self.category_timers.setdefault(category_id, timer)
+    
+    def _index_block(self, channel, message_id: int, text: str):
+        """افزودن دسته‌های یک پیام به ایندکس"""
+        key = (channel, message_id)
+        category_ids = []
+        for record in self._parse_block(text):
+            # تاریخچه از جدید به قدیم خوانده می‌شود؛ نسخه جدیدتر معتبر است
+            if record['id'] in self.message_cache:
+                continue
+            self.message_cache[record['id']] = (channel, message_id, record)
+            category_ids.append(record['id'])
+            if record['timer'] is not None:
+                self.category_timers[record['id']] = record['timer']
+        self.blocks[key] = category_ids
+    
+    def _index_required_channels(self, channel, message_id: int, text: str):
+        """خواندن لیست کانال‌های اجباری (فقط جدیدترین پیام معتبر است)"""
+        if self.required_channels_message:
+            return
+        self.required_channels_message = (channel, message_id)
+        for line in text.split('\n')[1:]:
+            parts = line.split('|', 2)
+            if len(parts) == 3 and parts[0]:
+                self.required_channels.append({'chat_id': parts[0], 'title': parts[2], 'link': parts[1]})
+    
+    async def save_required_channels(self, channels: list):
+        """ذخیره لیست کانال‌های اجباری در کانال ذخیره‌سازی"""
+        self.required_channels = list(channels)
+        if self.required_channels_message:
+            await self._write(self.required_channels_message)
+        elif self.channels:
+            message = await self._send_storage_message(self.channels[0], self._render_required_channels())
+            self.required_channels_message = (self.channels[0], message.message_id)
+    
+    def _render_required_channels(self) -> str:
+        return "===== REQUIRED CHANNELS =====\n" + '\n'.join(
+            f"{c['chat_id']}|{c['link'] or ''}|{c['title'].replace(chr(10), ' ')}" for c in self.required_channels
+        )
+    
+    def _index_shard(self, channel, message_id: int, text: str):
+        """افزودن یک پیام ادامه به ایندکس"""
+        records = self._parse_block("CATEGORIES_BLOCK:" + text[len("CATEGORY_SHARD:"):])
+        if records:
+            self.shards[(channel, message_id)] = records[0]
+    
+    async def _load_shards(self, refs: list, forward: bool = False) -> bool:
+        """دریافت همزمان shardهایی که در حافظه نیستند؛ False اگر بعضی دریافت نشدند
+
+        هر shard حداکثر یک دریافت در جریان دارد و shard ناموفق تا SHARD_RETRY_TTL دوباره درخواست نمی‌شود.
+        """
+        missing = [ref for ref in refs if ref not in self.shards]
+        if not missing:
+            return True
+        results = await asyncio.gather(*(self._get_shard(ref, forward) for ref in missing))
+        return all(results)
+    
+    async def _get_shard(self, ref, forward: bool) -> bool:
+        task = self.shard_fetches.get(ref)
+        if task is None:
+            failed_at = self.shard_failures.get(ref)
+            if failed_at is not None and time.monotonic() - failed_at < SHARD_RETRY_TTL:
+                return False
+            task = self.shard_fetches[ref] = asyncio.ensure_future(self._fetch_shard(ref, forward))
+        # لغو یک درخواست کاربر دریافت مشترک را لغو نمی‌کند
+        return await asyncio.shield(task)
+    
+    async def _fetch_shard(self, ref, forward: bool) -> bool:
+        """خواندن یک shard با شناسه پیام و ثبت نتیجه"""
+        try:
+            loaded = await self._read_shard(*ref, forward)
+        finally:
+            self.shard_fetches.pop(ref, None)
+        if loaded:
+            self.shard_failures.pop(ref, None)
+        else:
+            self.shard_failures[ref] = time.monotonic()
+        return loaded
+    
+    async def _read_shard(self, channel, message_id: int, forward: bool) -> bool:
+        try:
+            if hasattr(self.bot, 'get_messages'):
+                messages = await self.bot.get_messages(chat_id=channel, message_ids=[message_id])
+                message = messages[0] if messages else None
+            elif forward:
+                # Bot API پیام را با شناسه برنمی‌گرداند؛ یک کپی فوروارد شده خوانده و حذف می‌شود
+                message = await self.bot.forward_message(
+                    chat_id=channel, from_chat_id=channel, message_id=message_id, disable_notification=True
+                )
+                try:
+                    await self.bot.delete_message(chat_id=channel, message_id=message.message_id)
+                except Exception as e:
+                    logger.warning(f"حذف کپی موقت shard ناموفق: {e}")
+            else:
+                return False
+        except Exception as e:
+            logger.error(f"خطا در دریافت shard {channel}/{message_id}: {e}")
+            return False
+        if message and message.text and message.text.startswith("CATEGORY_SHARD:"):
+            self._index_shard(channel, message_id, message.text)
+            return True
+        logger.error(f"shard {channel}/{message_id} یافت نشد")
+        return False
+    
+    def _least_loaded_channel(self):
+        """کانالی که کمترین پیام ذخیره‌سازی را دارد"""
+        load = {channel: 0 for channel in self.channels}
+        for channel, _ in list(self.blocks) + list(self.shards):
+            if channel in load:
+                load[channel] += 1
+        return min(self.channels, key=lambda channel: load[channel])
+    
+    @staticmethod
+    def _parse_block(text: str) -> list:
+        """تبدیل متن CATEGORIES_BLOCK (فشرده یا قدیمی) به لیست رکوردها"""
+        header, _, body = text.partition('\n')
+        if header == f"CATEGORIES_BLOCK:{CompactCodec.VERSION}":
+            try:
+                return CompactCodec.decode(body)
+            except (ValueError, struct.error, zlib.error, UnicodeDecodeError) as e:
+                logger.error(f"خطا در خواندن پیام فشرده: {e}")
+                return []
+        
+        records = []
+        record = None
+        in_files = False
+        for line in text.split('\n')[1:]:
+            if line.startswith("CATEGORY:"):
+                record = {
+                    'id': line.split(':', 1)[1].strip(),
+                    'name': '',
+                    'created_by': None,
+                    'timer': None,
+                    'files': [],
+                    'shards': []
+                }
+                records.append(record)
+                in_files = False
+            elif record is None:
+                continue
+            elif in_files:
+                file_data = line.split('|', 2)
+                if len(file_data) >= 2:
+                    record['files'].append({
+                        'file_id': file_data[0],
+                        'file_type': file_data[1],
+                        'caption': file_data[2] if len(file_data) > 2 else ''
+                    })
+            elif line.startswith("NAME:"):
+                record['name'] = line.split(':', 1)[1]
+            elif line.startswith("CREATED_BY:"):
+                record['created_by'] = line.split(':', 1)[1]
+            elif line.startswith("TIMER:"):
+                try:
+                    record['timer'] = int(line.split(':', 1)[1])
+                except ValueError:
+                    pass
+            elif line.startswith("SHARDS:"):
+                for ref in line.split(':', 1)[1].split(','):
+                    channel, _, message_id = ref.rpartition('/')
+                    if channel and message_id.lstrip('-').isdigit():
+                        record['shards'].append((channel, int(message_id)))
+            elif line.startswith("FILES:"):
+                in_files = True
+        return records
+    
+    def _render_block(self, records: list) -> str:
+        """تبدیل لیست رکوردها به متن CATEGORIES_BLOCK"""
+        if STORAGE_ENCODING == 'compact':
+            return f"CATEGORIES_BLOCK:{CompactCodec.VERSION}\n{CompactCodec.encode(records)}"
+        
+        lines = ["CATEGORIES_BLOCK:"]
+        for record in records:
+            timer = record['timer'] if record['timer'] is not None else self.global_timer
+            lines.append(f"CATEGORY:{record['id']}")
+            lines.append(f"NAME:{record['name']}")
+            lines.append(f"CREATED_BY:{record['created_by']}")
+            lines.append(f"TIMER:{timer}")
+            if record.get('shards'):
+                lines.append("SHARDS:" + ','.join(f"{c}/{m}" for c, m in record['shards']))
+            lines.append("FILES:")
+            for file in record['files']:
+                caption = file.get('caption', '').replace('\n', ' ')
+                lines.append(f"{file['file_id']}|{file['file_type']}|{caption}")
+        return '\n'.join(lines)
+    
+    def _block_records(self, key) -> list:
+        """رکوردهای یک پیام به ترتیب ذخیره"""
+        return [self.message_cache[cid][2] for cid in self.blocks.get(key, [])]
+    
+    def _render_shard(self, shard: dict) -> str:
+        """تبدیل رکورد shard به متن CATEGORY_SHARD"""
+        return "CATEGORY_SHARD:" + self._render_block([shard])[len("CATEGORIES_BLOCK:"):]
+    
+    async def _edit_storage_message(self, key, new_text: str) -> bool:
+        """ویرایش پیام ذخیره‌سازی (write-through)"""
+        if len(new_text) > 4096:
+            return False
+        channel, message_id = key
+        await self.bot.edit_message_text(
+            chat_id=channel,
+            message_id=message_id,
+            text=new_text
+        )
+        self.written_texts[key] = new_text
+        self._remember(channel, message_id, new_text)
+        return True
+    
+    async def _send_storage_message(self, channel, text: str):
+        """ارسال پیام ذخیره‌سازی جدید و ثبت آن در نسخه محلی"""
+        message = await self.bot.send_message(chat_id=channel, text=text)
+        self.written_texts[(channel, message.message_id)] = text
+        self._remember(channel, message.message_id, text)
+        return message
+    
+    async def _delete_storage_message(self, channel, message_id: int):
+        """حذف پیام ذخیره‌سازی؛ نسخه محلی حتی در صورت خطا پاک می‌شود"""
+        self._remember(channel, message_id, None)
+        self.written_texts.pop((channel, message_id), None)
+        return await self.bot.delete_message(chat_id=channel, message_id=message_id)
+    
+    def _remember(self, channel, message_id: int, text: str = None):
+        """به‌روزرسانی نسخه محلی (ویرایش پیام‌های قدیمی در پیمایش افزایشی دیده نمی‌شود)"""
+        if not self.snapshot:
+            return
+        try:
+            if text is None:
+                self.snapshot.remove(channel, message_id)
+            else:
+                self.snapshot.put(channel, message_id, text)
+        except sqlite3.Error as e:
+            logger.error(f"خطا در به‌روزرسانی نسخه محلی: {e}")
+    
+    @staticmethod
+    def _fits(text: str) -> bool:
+        return len(text) <= 4096
+    
+    def _category_lock(self, category_id: str) -> asyncio.Lock:
+        """قفل تغییرات یک دسته (فقط تا زمانی که کسی منتظر آن است نگه داشته می‌شود)"""
+        lock = self.category_locks.get(category_id)
+        if lock is None:
+            lock = self.category_locks[category_id] = asyncio.Lock()
+        return lock
+    
+    def _message_lock(self, key) -> asyncio.Lock:
+        lock = self.message_locks.get(key)
+        if lock is None:
+            lock = self.message_locks[key] = asyncio.Lock()
+        return lock
+    
+    def _touch(self, key):
+        """ثبت تغییر حافظه یک پیام ذخیره‌سازی"""
+        self.versions[key] = self.versions.get(key, 0) + 1
+    
+    async def _write(self, key):
+        """ثبت تغییر و زمان‌بندی نوشتن آن در پنجره flush پیام"""
+        self._touch(key)
+        if self.flush_window <= 0:
+            await self._flush(key)
+            return
+        if key in self.flush_tasks:
+            # ویرایش بعدی این پیام از قبل زمان‌بندی شده و این تغییر را هم شامل می‌شود
+            return
+        delay = self.last_flush.get(key, float('-inf')) + self.flush_window - time.monotonic()
+        self.flush_tasks[key] = asyncio.create_task(self._delayed_flush(key, max(delay, 0)))
+    
+    async def _delayed_flush(self, key, delay: float):
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            if self.flush_tasks.get(key) is asyncio.current_task():
+                del self.flush_tasks[key]
+        try:
+            await self._flush(key)
+        except BadRequest as e:
+            # خطای دائمی؛ تلاش دوباره همان ویرایش فایده‌ای ندارد
+            logger.error(f"نوشتن پیام ذخیره‌سازی {key} رد شد: {e}")
+        except (RetryAfter, TimedOut, NetworkError) as e:
+            # خطای موقت؛ تلاش دوباره در پنجره بعدی
+            logger.warning(f"تاخیر در نوشتن پیام ذخیره‌سازی {key}: {e}")
+            if key not in self.flush_tasks:
+                wait = max(self.flush_window, getattr(e, 'retry_after', 0) or 0)
+                self.flush_tasks[key] = asyncio.create_task(self._delayed_flush(key, wait))
+        except Exception as e:
+            logger.error(f"خطا در نوشتن پیام ذخیره‌سازی {key}: {e}")
+    
+    def dirty_messages(self) -> list:
+        """پیام‌هایی که تغییرات نوشته نشده دارند"""
+        return [key for key, version in self.versions.items() if version > self.written.get(key, 0)]
+    
+    async def sync(self):
+        """نوشتن فوری همه تغییرات در انتظار (برای خاموش شدن یا درخواست ادمین)"""
+        tasks = list(self.flush_tasks.values())
+        self.flush_tasks.clear()
+        for task in tasks:
+            task.cancel()
+        dirty = self.dirty_messages()
+        results = await asyncio.gather(*(self._flush(key) for key in dirty), return_exceptions=True)
+        failed = [key for key, result in zip(dirty, results) if result is not True]
+        for key in failed:
+            logger.error(f"همگام‌سازی پیام ذخیره‌سازی {key} ناموفق بود")
+        return len(dirty) - len(failed), len(failed)
+    
+    def _render_key(self, key):
+        """متن فعلی پیام از روی حافظه (None اگر پیام دیگر وجود ندارد)"""
+        if key in self.blocks:
+            return self._render_block(self._block_records(key))
+        if key in self.shards:
+            return self._render_shard(self.shards[key])
+        if key == self.required_channels_message:
+            return self._render_required_channels()
+        return None
+    
+    async def _flush(self, key) -> bool:
+        """نوشتن آخرین وضعیت حافظه یک پیام در تلگرام؛ False اگر نوشته نشد
+
+        ویرایش‌ها با قفل هر پیام ترتیبی می‌شوند. تغییری که قبل از شروع یک ویرایش در حافظه
+        ثبت شده همراه همان ویرایش نوشته می‌شود و درخواست‌های منتظر بدون ویرایش اضافه برمی‌گردند.
+        اگر متن حاصل با متن فعلی پیام یکی باشد ویرایشی ارسال نمی‌شود و نسخه نوشته شده حساب می‌شود.
+        در صورت خطا پیام کثیف می‌ماند و در flush بعدی نوشته می‌شود.
+        """
+        target = self.versions.get(key, 0)
+        async with self._message_lock(key):
+            if self.written.get(key, 0) >= target:
+                return True
+            version = self.versions.get(key, 0)
+            text = self._render_key(key)
+            if text is None or text == self.written_texts.get(key):
+                # پیام دیگر وجود ندارد یا تغییر حافظه متن آن را عوض نکرده است
+                self.written[key] = version
+                return True
+            self.last_flush[key] = time.monotonic()
+            try:
+                if not await self._edit_storage_message(key, text):
+                    logger.error(f"پیام ذخیره‌سازی {key} از ظرفیت بزرگ‌تر است و نوشته نشد")
+                    return False
+            except BadRequest as e:
+                error = str(e).lower()
+                if 'message is not modified' in error:
+                    # متن پیام در تلگرام از قبل همین است
+                    self.written_texts[key] = text
+                elif 'message to edit not found' in error:
+                    # پیام از کانال حذف شده؛ تلاش دوباره فایده‌ای ندارد
+                    logger.error(f"پیام ذخیره‌سازی {key} وجود ندارد و کنار گذاشته شد")
+                    self._forget_message(key)
+                    return False
+                else:
+                    raise
+            self.written[key] = version
+            return True
+    
+    def _forget_message(self, key):
+        self.versions.pop(key, None)
+        self.written.pop(key, None)
+        self.written_texts.pop(key, None)
+        self.last_flush.pop(key, None)
+        task = self.flush_tasks.pop(key, None)
+        if task:
+            task.cancel()
     
     async def save_global_timer(self, seconds: int):
         """ذخیره تایمر جهانی در کانال ذخیره‌سازی"""
         self.global_timer = seconds
+        self._notify()
         
-        # حذف تایمرهای قدیمی
-        for channel in self.channels:
+        # حذف تایمر قدیمی
+        if self.global_timer_message:
+            channel, message_id = self.global_timer_message
             try:
-                async for message in self.bot.get_chat_history(chat_id=channel, limit=100):
-                    if message.text and "===== GLOBAL TIMER =====" in message.text:
-                        await message.delete()
+                await self._delete_storage_message(channel, message_id)
             except Exception as e:
                 logger.error(f"خطا در حذف تایمر قدیمی: {e}")
+            self.global_timer_message = None
         
         # ذخیره تایمر جدید
         if self.channels:
-            await self.bot.send_message(
-                chat_id=self.channels[0],
-                text=f"===== GLOBAL TIMER =====\n{seconds}"
+            message = await self._send_storage_message(self.channels[0], f"===== GLOBAL TIMER =====\n{seconds}")
+            self.global_timer_message = (self.channels[0], message.message_id)
+    
+    async def save_category_timer(self, category_id: str, seconds: int):
+        """ذخیره تایمر اختصاصی برای یک دسته"""
+        self.category_timers[category_id] = seconds
+        self._notify(category_id)
+        
+        async with self._category_lock(category_id):
+            entry = self.message_cache.get(category_id)
+            if not entry:
+                return
+            channel, message_id, record = entry
+            key = (channel, message_id)
+            updated = dict(record, timer=seconds)
+            if not self._fits(self._render_block([updated if r is record else r for r in self._block_records(key)])):
+                logger.error("تایمر دسته در پیام ذخیره‌سازی جا نمی‌شود")
+                return
+            record['timer'] = seconds
+            try:
+                await self._write(key)
+            except Exception as e:
+                logger.error(f"خطا در به‌روزرسانی تایمر دسته: {e}")
+    
+    async def _find_message_for_category(self, category_id: str = None):
+        """پیدا کردن پیام مناسب برای دسته"""
+        if category_id:
+            entry = self.message_cache.get(category_id)
+            if entry:
+                return entry[0], entry[1]
+            return None, None
+        
+        # اولین پیامی که جای خالی دارد
+        for key, category_ids in self.blocks.items():
+            if len(category_ids) < self.categories_per_message:
+                return key
+        return None, None
+    
+    async def add_category(self, name: str, created_by: int, category_id: str = None) -> str:
+        """ایجاد دسته جدید"""
+        category_id = category_id or str(uuid.uuid4())[:8]
+        record = {
+            'id': category_id,
+            'name': name.replace('\n', ' '),
+            'created_by': str(created_by),
+            'timer': self.global_timer,
+            'files': [],
+            'shards': []
+        }
+        
+        key = await self._find_message_for_category()
+        
+        if key[0] is not None and self._fits(self._render_block(self._block_records(key) + [record])):
+            # افزودن به پیام موجود
+            self.blocks[key].append(category_id)
+            self.message_cache[category_id] = (key[0], key[1], record)
+            try:
+                await self._write(key)
+            except Exception as e:
+                logger.error(f"خطا در افزودن دسته به پیام موجود: {e}")
+        else:
+            # اگر پیام پر شد، پیام جدید در کم‌بارترین کانال ایجاد کنید
+            channel = self._least_loaded_channel()
+            
+            message = await self._send_storage_message(channel, self._render_block([record]))
+            key = (channel, message.message_id)
+            self.blocks[key] = [category_id]
+            self.message_cache[category_id] = (key[0], key[1], record)
+        
+        # ذخیره تایمر در کش
+        self.category_timers[category_id] = self.global_timer
+        
+        return category_id
+    
+    async def get_categories(self) -> dict:
+        """دریافت تمام دسته‌ها"""
+        return {cid: entry[2]['name'] for cid, entry in self.message_cache.items()}
+    
+    async def get_category(self, category_id: str) -> dict:
+        """دریافت اطلاعات یک دسته"""
+        entry = self.message_cache.get(category_id)
+        if not entry:
+            return None
+        record = entry[2]
+        files = list(record['files'])
+        complete = True
+        if record['shards']:
+            complete = await self._load_shards(record['shards'])
+            for ref in record['shards']:
+                shard = self.shards.get(ref)
+                if shard:
+                    files.extend(shard['files'])
+        return {
+            'name': record['name'],
+            'timer': self.get_category_timer(category_id),
+            'files': files,
+            'partial': not complete  # بعضی shardها دریافت نشدند
+        }
+    
+    async def add_file(self, category_id: str, file_info: dict) -> bool:
+        """افزودن فایل به دسته"""
+        results = await self.add_files(category_id, [file_info])
+        return results[0]
+    
+    async def add_files(self, category_id: str, files: list) -> list:
+        """افزودن گروهی فایل‌ها با یک ویرایش؛ نتیجه هر فایل جداگانه برگردانده می‌شود"""
+        async with self._category_lock(category_id):
+            try:
+                return await self._add_files(category_id, files)
+            finally:
+                self._notify(category_id)
+    
+    async def _add_files(self, category_id: str, files: list) -> list:
+        results = [False] * len(files)
+        entry = self.message_cache.get(category_id)
+        if not entry or not files:
+            return results
+        channel, message_id, record = entry
+        key = (channel, message_id)
+        
+        new_files = []
+        positions = []
+        for i, file_info in enumerate(files):
+            new_file = {
+                'file_id': file_info['file_id'],
+                'file_type': file_info['file_type'],
+                'caption': file_info.get('caption', '')
+            }
+            # فایلی که به تنهایی در یک پیام جا نمی‌شود قابل ذخیره نیست
+            if len(self._render_shard(self._new_shard(category_id, [new_file]))) > 4096:
+                logger.warning(f"فایل {new_file['file_id'][:16]} از ظرفیت پیام بزرگ‌تر است")
+                continue
+            new_files.append(new_file)
+            positions.append(i)
+        if not new_files:
+            return results
+        
+        try:
+            if record['shards']:
+                # پر کردن آخرین shard و ساخت shard جدید برای باقیمانده
+                shard_key = record['shards'][-1]
+                shard = self.shards.get(shard_key)
+                fitted = 0
+                if shard:
+                    fitted = self._fit_count(
+                        lambda extra: self._render_shard(dict(shard, files=shard['files'] + extra)),
+                        new_files
+                    )
+                    if fitted:
+                        shard['files'].extend(new_files[:fitted])
+                        await self._write(shard_key)
+                for i in positions[:fitted]:
+                    results[i] = True
+                if fitted < len(new_files) and await self._add_shards(record, new_files[fitted:]):
+                    for i in positions[fitted:]:
+                        results[i] = True
+            else:
+                updated = dict(record, files=record['files'] + new_files)
+                records = [updated if r is record else r for r in self._block_records(key)]
+                # بررسی اندازه پیام
+                if self._fits(self._render_block(records)):
+                    record['files'].extend(new_files)
+                    await self._write(key)
+                    added = True
+                else:
+                    # پیام پر است؛ فایل‌ها به shard منتقل می‌شوند
+                    added = await self._add_shards(record, new_files)
+                if added:
+                    for i in positions:
+                        results[i] = True
+        except Exception as e:
+            logger.error(f"خطا در افزودن فایل‌ها: {e}")
+        return results
+    
+    def _fit_count(self, render, new_files: list) -> int:
+        """بیشترین تعداد فایل‌های جدیدی که در پیام جا می‌شوند (جستجوی دودویی)"""
+        low, high = 0, len(new_files)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if len(render(new_files[:mid])) <= 4096:
+                low = mid
+            else:
+                high = mid - 1
+        return low
+    
+    @staticmethod
+    def _new_shard(category_id: str, files: list) -> dict:
+        return {
+            'id': category_id,
+            'name': '',
+            'created_by': None,
+            'timer': None,
+            'files': files,
+            'shards': []
+        }
+    
+    def _chunk_files(self, category_id: str, files: list) -> list:
+        """تقسیم فایل‌ها به گروه‌هایی که هر کدام در یک پیام جا شوند"""
+        chunks = []
+        current = []
+        for file in files:
+            candidate = current + [file]
+            if len(self._render_shard(self._new_shard(category_id, candidate))) <= 4096:
+                current = candidate
+            elif current:
+                chunks.append(current)
+                current = [file]
+            else:
+                # یک فایل به تنهایی از ظرفیت پیام بیشتر است
+                return None
+        if current:
+            chunks.append(current)
+        return chunks
+    
+    async def _add_shards(self, record: dict, files: list) -> bool:
+        """ساخت پیام‌های ادامه برای دسته و ثبت ارجاع آن‌ها در پیام اصلی"""
+        channel, message_id, _ = self.message_cache[record['id']]
+        key = (channel, message_id)
+        
+        # با اولین shard، فایل‌های پیام اصلی هم منتقل می‌شوند تا پیام مشترک جا باز کند
+        head_files = record['files'] if record['shards'] else []
+        moved_files = [] if record['shards'] else record['files']
+        chunks = self._chunk_files(record['id'], moved_files + files)
+        if not chunks:
+            return False
+        
+        created = []
+        new_key = None
+        try:
+            for chunk in chunks:
+                shard = self._new_shard(record['id'], chunk)
+                shard_channel = self._least_loaded_channel()
+                message = await self._send_storage_message(shard_channel, self._render_shard(shard))
+                shard_key = (shard_channel, message.message_id)
+                self.shards[shard_key] = shard
+                created.append(shard_key)
+            
+            updated = dict(record, files=head_files, shards=record['shards'] + created)
+            records = [updated if r is record else r for r in self._block_records(key)]
+            if not self._fits(self._render_block(records)):
+                # جایی برای ارجاع نیست؛ دسته به پیام جدید در کم‌بارترین کانال منتقل می‌شود
+                new_channel = self._least_loaded_channel()
+                message = await self._send_storage_message(new_channel, self._render_block([updated]))
+                new_key = (new_channel, message.message_id)
+        except Exception:
+            # حذف shardهای یتیم
+            for shard_channel, shard_message_id in created:
+                self.shards.pop((shard_channel, shard_message_id), None)
+                try:
+                    await self._delete_storage_message(shard_channel, shard_message_id)
+                except Exception as e:
+                    logger.warning(f"حذف shard ناموفق: {e}")
+            raise
+        
+        # از اینجا shardها در حافظه ثبت شده‌اند؛ خطای ویرایش بعدی در flush بعدی جبران می‌شود
+        record['files'] = head_files
+        record['shards'] = record['shards'] + created
+        if new_key is None:
+            await self._write(key)
+        else:
+            await self._move_to_new_block(key, record, new_key)
+        return True
+    
+    async def _move_to_new_block(self, key, record: dict, new_key):
+        """ثبت انتقال دسته به پیام جدید و پاکسازی پیام قبلی"""
+        self.blocks[new_key] = [record['id']]
+        self.message_cache[record['id']] = (new_key[0], new_key[1], record)
+        self.blocks[key].remove(record['id'])
+        if self.blocks[key]:
+            await self._write(key)
+        else:
+            del self.blocks[key]
+            self._forget_message(key)
+            await self._delete_storage_message(key[0], key[1])
+    
+    async def delete_category(self, category_id: str) -> bool:
+        """حذف یک دسته"""
+        async with self._category_lock(category_id):
+            entry = self.message_cache.get(category_id)
+            if not entry:
+                return False
+            channel, message_id, record = entry
+            key = (channel, message_id)
+            
+            try:
+                del self.message_cache[category_id]
+                self.blocks[key].remove(category_id)
+                self.category_timers.pop(category_id, None)
+                self._notify(category_id)
+                
+                # اگر پیام خالی شد، آن را حذف کنید
+                if not self.blocks[key]:
+                    del self.blocks[key]
+                    self._forget_message(key)
+                    await self._delete_storage_message(channel, message_id)
+                else:
+                    await self._write(key)
+                
+                # حذف پیام‌های ادامه
+                for ref in record['shards']:
+                    self.shards.pop(ref, None)
+                    self._forget_message(ref)
+                results = await asyncio.gather(
+                    *(self._delete_storage_message(c, m) for c, m in record['shards']),
+                    return_exceptions=True
+                )
+                for result in results:
+                    if isinstance(result, Exception):
+                        logger.warning(f"حذف shard ناموفق: {result}")
+                return True
+            except Exception as e:
+                logger.error(f"خطا در حذف دسته: {e}")
+            return False
+
+class SQLiteStorage(StorageBackend):
+    """ذخیره‌سازی محلی در SQLite (حالت WAL) با کانال تلگرام به عنوان پشتیبان"""
+    
+    def __init__(self, path: str, mirror: ChannelStorage = None):
+        super().__init__()
+        self.path = path
+        self.mirror = mirror
+        self.conn = None
+        self.mirror_queue = asyncio.Queue()
+        self.mirror_task = None
+        self.loaded = False
+    
+    async def initialize(self):
+        """باز کردن پایگاه داده و بارگذاری تنظیمات"""
+        if self.loaded:
+            return
+        
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS settings (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS categories (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                created_by INTEGER,
+                timer INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                category_id TEXT NOT NULL REFERENCES categories(id) ON DELETE CASCADE,
+                file_id TEXT NOT NULL,
+                file_type TEXT NOT NULL,
+                caption TEXT NOT NULL DEFAULT ''
+            );
+            CREATE INDEX IF NOT EXISTS idx_files_category ON files(category_id, id);
+            CREATE TABLE IF NOT EXISTS required_channels (
+                chat_id TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                link TEXT,
+                position INTEGER NOT NULL
+            );
+        """)
+        self.conn.commit()
+        
+        row = self.conn.execute("SELECT value FROM settings WHERE key = 'global_timer'").fetchone()
+        if row:
+            self.global_timer = int(row[0])
+        
+        if self.mirror:
+            await self.mirror.initialize()
+            # مهاجرت اولیه از کانال‌ها در صورت خالی بودن پایگاه داده
+            if not self.conn.execute("SELECT 1 FROM categories LIMIT 1").fetchone():
+                await self._import_from(self.mirror)
+            self.mirror_task = asyncio.create_task(self._mirror_worker())
+        
+        for category_id, timer in self.conn.execute(
+                "SELECT id, timer FROM categories WHERE timer IS NOT NULL"):
+            self.category_timers[category_id] = timer
+        
+        self.required_channels = [
+            {'chat_id': chat_id, 'title': title, 'link': link}
+            for chat_id, title, link in self.conn.execute(
+                "SELECT chat_id, title, link FROM required_channels ORDER BY position")
+        ]
+        
+        self.loaded = True
+        logger.info(f"SQLite storage initialized: {self.path}")
+    
+    async def _import_from(self, source: StorageBackend):
+        """انتقال داده‌های موجود از کانال ذخیره‌سازی به پایگاه داده
+
+        اگر بعضی shardها دریافت نشوند مهاجرت انجام نمی‌شود؛ پس از اولین دسته، مهاجرت دیگر تکرار نمی‌شود
+        و فایل‌های جا افتاده برای همیشه از پایگاه داده حذف می‌مانند.
+        """
+        categories = {}
+        for category_id in await source.get_categories():
+            category = await source.get_category(category_id)
+            if not category:
+                continue
+            if category.get('partial'):
+                logger.error(f"مهاجرت به SQLite متوقف شد: shardهای دسته {category_id} دریافت نشدند")
+                raise RuntimeError("انتقال داده‌ها از کانال ذخیره‌سازی ناقص است؛ پایگاه داده خالی ماند")
+            categories[category_id] = category
+        
+        index = source.message_cache if isinstance(source, ChannelStorage) else {}
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES ('global_timer', ?)",
+                (str(source.global_timer),)
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO required_channels (chat_id, title, link, position) VALUES (?, ?, ?, ?)",
+                [(c['chat_id'], c['title'], c['link'], i) for i, c in enumerate(source.required_channels)]
+            )
+            for category_id, category in categories.items():
+                created_by = index[category_id][2].get('created_by') if category_id in index else None
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO categories (id, name, created_by, timer) VALUES (?, ?, ?, ?)",
+                    (category_id, category['name'],
+                     int(created_by) if created_by and str(created_by).lstrip('-').isdigit() else None,
+                     source.category_timers.get(category_id))
+                )
+                self.conn.executemany(
+                    "INSERT INTO files (category_id, file_id, file_type, caption) VALUES (?, ?, ?, ?)",
+                    [(category_id, f['file_id'], f['file_type'], f.get('caption', '')) for f in category['files']]
+                )
+        self.global_timer = source.global_timer
+        logger.info(f"{len(categories)} دسته از کانال ذخیره‌سازی منتقل شد")
+    
+    def _mirror(self, method: str, *args):
+        """ارسال تغییر به کانال پشتیبان بدون انتظار"""
+        if self.mirror:
+            self.mirror_queue.put_nowait((method, args))
+    
+    async def sync(self):
+        """انتظار برای صف پشتیبان و نوشتن تغییرات بافر شده آن"""
+        if not self.mirror:
+            return 0, 0
+        await self.mirror_queue.join()
+        return await self.mirror.sync()
+    
+    async def _mirror_worker(self):
+        """اجرای ترتیبی تغییرات روی کانال پشتیبان"""
+        while True:
+            method, args = await self.mirror_queue.get()
+            try:
+                await getattr(self.mirror, method)(*args)
+            except Exception as e:
+                logger.error(f"خطا در همگام‌سازی کانال پشتیبان ({method}): {e}")
+            finally:
+                self.mirror_queue.task_done()
+    
+    async def save_global_timer(self, seconds: int):
+        """ذخیره تایمر جهانی"""
+        self.global_timer = seconds
+        self._notify()
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES ('global_timer', ?)",
+                (str(seconds),)
+            )
+        self._mirror('save_global_timer', seconds)
+    
+    async def save_category_timer(self, category_id: str, seconds: int):
+        """ذخیره تایمر اختصاصی برای یک دسته"""
+        self.category_timers[category_id] = seconds
+        self._notify(category_id)
+        with self.conn:
+            self.conn.execute("UPDATE categories SET timer = ? WHERE id = ?", (seconds, category_id))
+        self._mirror('save_category_timer', category_id, seconds)
+    
+    async def add_category(self, name: str, created_by: int, category_id: str = None) -> str:
+        """ایجاد دسته جدید"""
+        category_id = category_id or str(uuid.uuid4())[:8]
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO categories (id, name, created_by, timer) VALUES (?, ?, ?, ?)",
+                (category_id, name, created_by, self.global_timer)
             )
+        self.category_timers[category_id] = self.global_timer
+        self._mirror('add_category', name, created_by, category_id)
+        return category_id
+    
+    async def get_categories(self) -> dict:
+        """دریافت تمام دسته‌ها"""
+        return dict(self.conn.execute("SELECT id, name FROM categories ORDER BY rowid"))
+    
+    async def get_category(self, category_id: str) -> dict:
+        """دریافت اطلاعات یک دسته"""
+        row = self.conn.execute("SELECT name FROM categories WHERE id = ?", (category_id,)).fetchone()
+        if not row:
+            return None
+        files = [
+            {'file_id': file_id, 'file_type': file_type, 'caption': caption}
+            for file_id, file_type, caption in self.conn.execute(
+                "SELECT file_id, file_type, caption FROM files WHERE category_id = ? ORDER BY id",
+                (category_id,)
+            )
+        ]
+        return {
+            'name': row[0],
+            'timer': self.get_category_timer(category_id),
+            'files': files
+        }
+    
+    async def add_file(self, category_id: str, file_info: dict) -> bool:
+        """افزودن فایل به دسته"""
+        try:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO files (category_id, file_id, file_type, caption) VALUES (?, ?, ?, ?)",
+                    (category_id, file_info['file_id'], file_info['file_type'], file_info.get('caption', ''))
+                )
+        except sqlite3.IntegrityError:
+            return False
+        self._notify(category_id)
+        self._mirror('add_file', category_id, file_info)
+        return True
+    
+    async def add_files(self, category_id: str, files: list) -> list:
+        """افزودن گروهی فایل‌ها در یک تراکنش"""
+        try:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT INTO files (category_id, file_id, file_type, caption) VALUES (?, ?, ?, ?)",
+                    [(category_id, f['file_id'], f['file_type'], f.get('caption', '')) for f in files]
+                )
+        except sqlite3.IntegrityError:
+            return [False] * len(files)
+        self._notify(category_id)
+        self._mirror('add_files', category_id, files)
+        return [True] * len(files)
+    
+    async def delete_category(self, category_id: str) -> bool:
+        """حذف یک دسته"""
+        with self.conn:
+            deleted = self.conn.execute("DELETE FROM categories WHERE id = ?", (category_id,)).rowcount
+        if not deleted:
+            return False
+        self.category_timers.pop(category_id, None)
+        self._notify(category_id)
+        self._mirror('delete_category', category_id)
+        return True
+    
+    async def save_required_channels(self, channels: list):
+        """ذخیره لیست کانال‌های اجباری"""
+        with self.conn:
+            self.conn.execute("DELETE FROM required_channels")
+            self.conn.executemany(
+                "INSERT INTO required_channels (chat_id, title, link, position) VALUES (?, ?, ?, ?)",
+                [(c['chat_id'], c['title'], c['link'], i) for i, c in enumerate(channels)]
+            )
+        self.required_channels = list(channels)
+        self._mirror('save_required_channels', channels)
+
+class TokenBucket:
+    """محدودکننده نرخ به روش سطل توکن"""
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+    
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def acquire(self, tokens: float = 1):
+        """انتظار تا آزاد شدن توکن"""
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+    
+    def pause(self, seconds: float):
+        """توقف کامل تا پایان مهلت RetryAfter"""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+    
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+class DeliveryEngine:
+    """ارسال پیام‌ها با رعایت محدودیت نرخ سراسری و هر چت"""
+    
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_SEND_RATE, GLOBAL_SEND_RATE)
+        self.chat_buckets = {}
+        self.max_retries = 3
+        self.queue_depth = 0
+    
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # پاکسازی سطل‌های بیکار برای ثابت ماندن مصرف حافظه
+            if len(self.chat_buckets) >= 10000:
+                now = time.monotonic()
+                for idle_chat in [c for c, b in self.chat_buckets.items() if b.is_idle(now)]:
+                    del self.chat_buckets[idle_chat]
+            bucket = TokenBucket(CHAT_SEND_RATE, CHAT_SEND_BURST)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+    
+    async def send(self, chat_id, send_func, /, *args, **kwargs):
+        """اجرای یک درخواست ارسال با انتظار دقیق RetryAfter"""
+        bucket = self._chat_bucket(chat_id)
+        self.queue_depth += 1
+        try:
+            for attempt in range(self.max_retries + 1):
+                await bucket.acquire()
+                await self.global_bucket.acquire()
+                try:
+                    return await send_func(*args, **kwargs)
+                except RetryAfter as e:
+                    metrics.inc('telegram_retry_after_total', source='delivery')
+                    if attempt == self.max_retries:
+                        raise
+                    logger.warning(f"محدودیت ارسال برای {chat_id}: انتظار {e.retry_after} ثانیه")
+                    bucket.pause(e.retry_after)
+                except TimedOut:
+                    if attempt == self.max_retries:
+                        raise
+                    await asyncio.sleep(2 ** attempt)
+        finally:
+            self.queue_depth -= 1
+
+class DeliveryPlan:
+    """برنامه ارسال آماده و تغییرناپذیر یک دسته"""
+    __slots__ = ('name', 'timer', 'file_count', 'header', 'warning', 'batches')
+    
+    def __init__(self, category: dict, timer: int):
+        self.name = category['name']
+        self.timer = timer
+        self.file_count = len(category['files'])
+        self.header = f"📤 ارسال فایل‌های '{self.name}'..."
+        # متن هشدار حالت تطبیقی ثابت است؛ حالت static زمان حذف را هنگام ارسال می‌سازد
+        self.warning = (
+            f"⚠️ فایل‌ها بعد از {timer} ثانیه به صورت خودکار حذف خواهند شد!\n"
+            f"زمان باقیمانده: {timer} ثانیه"
+        ) if timer > 0 and COUNTDOWN_MODE != 'static' else None
+        
+        files = [file for file in category['files'] if file['file_type'] in SEND_METHODS]
+        groups = build_media_groups(files) if ALBUM_MODE else [[file] for file in files]
+        # هر دسته: (رسانه‌های آلبوم یا None, ارسال‌های تکی)؛ ارسال تکی: (متد, نام پارامتر, file_id, کپشن)
+        self.batches = tuple(
+            (
+                tuple(
+                    INPUT_MEDIA[file['file_type']][0](media=file['file_id'], caption=file.get('caption', '')[:1024])
+                    for file in group
+                ) if len(group) > 1 else None,
+                tuple(
+                    (SEND_METHODS[file['file_type']], file['file_type'], file['file_id'], file.get('caption', '')[:1024])
+                    for file in group
+                )
+            )
+            for group in groups
+        )
+
+class DeliveryPlanCache:
+    """کش برنامه ارسال دسته‌ها که با تغییرات لایه ذخیره‌سازی باطل می‌شود"""
+    
+    def __init__(self):
+        self.plans = {}  # category_id -> DeliveryPlan
+        self.generations = {}  # category_id -> شمارنده ابطال (برای رد برنامه‌های ساخته شده در حین تغییر)
+        self.epoch = 0  # ابطال همه برنامه‌ها (تایمر جهانی)
+        self.hits = 0
+        self.misses = 0
+    
+    def attach(self, storage: StorageBackend):
+        storage.add_listener(self.invalidate)
+    
+    def invalidate(self, category_id: str = None):
+        if category_id is None:
+            self.plans.clear()
+            self.epoch += 1
+        else:
+            self.plans.pop(category_id, None)
+            self.generations[category_id] = self.generations.get(category_id, 0) + 1
+    
+    async def get(self, storage: StorageBackend, category_id: str):
+        """برنامه ارسال دسته یا None اگر دسته وجود ندارد"""
+        plan = self.plans.get(category_id)
+        if plan is not None:
+            self.hits += 1
+            return plan
+        self.misses += 1
+        
+        stamp = (self.epoch, self.generations.get(category_id, 0))
+        category = await storage.get_category(category_id)
+        if not category:
+            return None
+        plan = DeliveryPlan(category, storage.get_category_timer(category_id))
+        # اگر دسته هنگام خواندن تغییر کرده یا ناقص خوانده شده، برنامه فقط برای همین ارسال استفاده می‌شود
+        if stamp == (self.epoch, self.generations.get(category_id, 0)) and not category.get('partial'):
+            self.plans[category_id] = plan
+        return plan
+
+async def delete_messages_bulk(bot, chat_id: int, message_ids: list, delivery: 'DeliveryEngine') -> list:
+    """حذف گروهی پیام‌ها با deleteMessages (حداکثر ۱۰۰ شناسه در هر درخواست)
+
+    درخواست‌ها از موتور تحویل عبور می‌کنند تا محدودیت نرخ و RetryAfter رعایت شود.
+    خروجی شناسه‌هایی است که به دلیل خطای موقت حذف نشدند؛ پیام‌هایی که قابل حذف نیستند
+    (BadRequest مانند پیام حذف شده یا قدیمی، Forbidden مانند مسدود شدن ربات) انجام شده حساب می‌شوند.
+    """
+    remaining = []
+    for start in range(0, len(message_ids), 100):
+        chunk = message_ids[start:start + 100]
+        try:
+            if hasattr(bot, 'delete_messages'):
+                await delivery.send(chat_id, bot.delete_messages, chat_id=chat_id, message_ids=chunk)
+            else:
+                # نسخه‌های قدیمی‌تر PTB متد deleteMessages را ندارند
+                await delivery.send(chat_id, bot._post, 'deleteMessages', data={'chat_id': chat_id, 'message_ids': chunk})
+            continue
+        except Forbidden as e:
+            # ربات دیگر به این چت دسترسی ندارد؛ تلاش دوباره فایده‌ای ندارد
+            logger.info(f"حذف پیام‌ها در {chat_id} ممکن نیست: {e}")
+            continue
+        except BadRequest as e:
+            # بعضی پیام‌ها قابل حذف نیستند؛ بقیه تکی حذف می‌شوند
+            logger.warning(f"حذف گروهی ناموفق، حذف تکی: {e}")
+        except (RetryAfter, NetworkError) as e:
+            logger.warning(f"حذف گروهی به تعویق افتاد: {e}")
+            remaining.extend(chunk)
+            continue
+        
+        for msg_id in chunk:
+            try:
+                await delivery.send(chat_id, bot.delete_message, chat_id=chat_id, message_id=msg_id)
+            except (BadRequest, Forbidden) as e:
+                logger.info(f"پیام {msg_id} قابل حذف نیست: {e}")
+            except (RetryAfter, NetworkError) as e:
+                logger.warning(f"حذف پیام به تعویق افتاد: {e}")
+                remaining.append(msg_id)
+    return remaining
+
+class DeletionJournal:
+    """ذخیره پایدار حذف‌های زمان‌بندی شده در SQLite"""
+    
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pending_deletions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                message_ids TEXT NOT NULL,
+                due REAL NOT NULL,
+                warning_id INTEGER,
+                user_id INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS idx_pending_deletions_due ON pending_deletions(due);
+        """)
+        self.conn.commit()
+    
+    def add(self, entry: dict) -> int:
+        with self.conn:
+            cursor = self.conn.execute(
+                "INSERT INTO pending_deletions (chat_id, message_ids, due, warning_id, user_id) VALUES (?, ?, ?, ?, ?)",
+                (entry['chat_id'], json.dumps(entry['message_ids']), entry['due'], entry['warning_id'], entry['user_id'])
+            )
+        return cursor.lastrowid
+    
+    def remove(self, entry_ids: list):
+        with self.conn:
+            self.conn.executemany("DELETE FROM pending_deletions WHERE id = ?", [(eid,) for eid in entry_ids])
+    
+    def update(self, entry_id: int, entry: dict):
+        """ثبت پیام‌های باقی‌مانده و سررسید جدید پس از تلاش ناموفق"""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE pending_deletions SET message_ids = ?, due = ?, warning_id = ? WHERE id = ?",
+                (json.dumps(entry['message_ids']), entry['due'], entry['warning_id'], entry_id))
+    
+    def load(self) -> dict:
+        """همه حذف‌های ثبت شده به ترتیب سررسید"""
+        return {
+            row[0]: {
+                'chat_id': row[1],
+                'message_ids': json.loads(row[2]),
+                'due': row[3],
+                'warning_id': row[4],
+                'user_id': row[5]
+            }
+            for row in self.conn.execute(
+                "SELECT id, chat_id, message_ids, due, warning_id, user_id FROM pending_deletions ORDER BY due")
+        }
+
+class DeletionScheduler:
+    """زمان‌بند مرکزی حذف خودکار پیام‌ها با یک heap و یک وظیفه"""
+    
+    def __init__(self, delivery: 'DeliveryEngine'):
+        self.bot = None
+        self.journal = None
+        self.delivery = delivery  # حذف‌ها هم از محدودیت نرخ ارسال پیروی می‌کنند
+        self.heap = []  # (due, entry_id)
+        self.entries = {}  # entry_id -> {'chat_id', 'message_ids', 'due', 'warning_id', 'user_id'}
+        self.counter = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.tick = 10  # فاصله به‌روزرسانی شمارش معکوس
+        self.semaphore = asyncio.Semaphore(DELETE_CONCURRENCY)
+    
+    def start(self, bot, journal: DeletionJournal = None):
+        """شروع وظیفه زمان‌بند و بازیابی حذف‌های ذخیره شده"""
+        self.bot = bot
+        self.journal = journal
+        if journal:
+            restored = journal.load()
+            now = time.time()
+            overdue = sum(1 for entry in restored.values() if entry['due'] <= now)
+            for entry_id, entry in restored.items():
+                self.entries[entry_id] = entry
+                heapq.heappush(self.heap, (entry['due'], entry_id))
+            if restored:
+                logger.info(f"{len(restored)} حذف در انتظار بازیابی شد ({overdue} سررسید گذشته)")
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """توقف وظیفه زمان‌بند؛ حذف‌های در انتظار در ذخیره پایدار می‌مانند"""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+    
+    def schedule(self, chat_id: int, message_ids: list, delay: int, warning_id: int = None, user_id: int = None) -> int:
+        """ثبت پیام‌ها برای حذف پس از delay ثانیه"""
+        due = time.time() + delay
+        entry = {
+            'chat_id': chat_id,
+            'message_ids': list(message_ids),
+            'due': due,
+            'warning_id': warning_id,
+            'user_id': user_id,
+            'next_update': time.time() + self._countdown_interval(delay)
+        }
+        entry_id = next(self.counter)
+        if self.journal:
+            try:
+                entry_id = self.journal.add(entry)
+            except sqlite3.Error as e:
+                logger.error(f"خطا در ذخیره حذف زمان‌بندی شده: {e}")
+                entry_id = -entry_id - 1  # شناسه منفی تداخلی با ردیف‌های پایگاه داده ندارد
+        self.entries[entry_id] = entry
+        heapq.heappush(self.heap, (due, entry_id))
+        self.wakeup.set()
+        return entry_id
+    
+    def cancel_user(self, user_id: int) -> int:
+        """لغو حذف‌های در انتظار یک کاربر"""
+        cancelled = [eid for eid, entry in self.entries.items() if entry['user_id'] == user_id]
+        for entry_id in cancelled:
+            # ورودی heap در زمان سررسید نادیده گرفته می‌شود
+            del self.entries[entry_id]
+        self._forget(cancelled)
+        if cancelled:
+            logger.info("حذف پیام‌ها لغو شد")
+        return len(cancelled)
+    
+    @property
+    def active_count(self) -> int:
+        return len(self.entries)
+    
+    async def _run(self):
+        next_tick = time.time() + self.tick
+        while True:
+            try:
+                now = time.time()
+                due = {}
+                while self.heap and self.heap[0][0] <= now:
+                    _, entry_id = heapq.heappop(self.heap)
+                    entry = self.entries.pop(entry_id, None)
+                    if entry:
+                        due[entry_id] = entry
+                if due:
+                    done = await self._expire(due)
+                    self._forget(done)
+                
+                if now >= next_tick:
+                    next_tick = now + self.tick
+                    await self._update_countdowns(now)
+                
+                timeout = next_tick - time.time()
+                if self.heap:
+                    timeout = min(timeout, self.heap[0][0] - time.time())
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"خطای غیرمنتظره در تایمر حذف: {e}")
+                await asyncio.sleep(1)
+    
+    def _forget(self, entry_ids: list):
+        """حذف ورودی‌های انجام یا لغو شده از ذخیره پایدار"""
+        if self.journal and entry_ids:
+            try:
+                self.journal.remove(entry_ids)
+            except sqlite3.Error as e:
+                logger.error(f"خطا در پاکسازی حذف‌های ذخیره شده: {e}")
+    
+    async def _expire(self, entries: dict) -> list:
+        """حذف دسته‌ای پیام‌های سررسید شده؛ خروجی شناسه ورودی‌های تمام شده است"""
+        results = await asyncio.gather(
+            *(self._delete_entry(entry) for entry in entries.values()), return_exceptions=True)
+        done = []
+        for (entry_id, entry), remaining in zip(entries.items(), results):
+            if isinstance(remaining, TelegramError):
+                # خطای دائمی تلگرام برای این چت؛ تلاش دوباره فایده‌ای ندارد
+                logger.error(f"حذف پیام‌های چت {entry['chat_id']} ناموفق بود: {remaining}")
+                done.append(entry_id)
+            elif isinstance(remaining, Exception):
+                logger.error(f"خطای غیرمنتظره در حذف پیام‌های چت {entry['chat_id']}: {remaining}")
+                self._retry(entry_id, entry, entry['message_ids'])
+            elif remaining:
+                self._retry(entry_id, entry, remaining)
+            else:
+                done.append(entry_id)
+        return done
+    
+    def _retry(self, entry_id: int, entry: dict, remaining: list):
+        """زمان‌بندی دوباره پیام‌هایی که به دلیل خطای موقت حذف نشدند"""
+        entry['attempts'] = entry.get('attempts', 0) + 1
+        entry['message_ids'] = remaining
+        entry['warning_id'] = None  # شمارش معکوس دیگر معنایی ندارد
+        entry['due'] = time.time() + min(DELETE_RETRY_MAX, 30 * 2 ** (entry['attempts'] - 1))
+        self.entries[entry_id] = entry
+        heapq.heappush(self.heap, (entry['due'], entry_id))
+        logger.warning(f"{len(remaining)} پیام حذف نشد؛ تلاش دوباره در {int(entry['due'] - time.time())} ثانیه")
+        if self.journal and entry_id >= 0:
+            try:
+                self.journal.update(entry_id, entry)
+            except sqlite3.Error as e:
+                logger.error(f"خطا در به‌روزرسانی حذف زمان‌بندی شده: {e}")
+    
+    async def _delete_entry(self, entry: dict):
+        async with self.semaphore:
+            return await delete_messages_bulk(self.bot, entry['chat_id'], entry['message_ids'], self.delivery)
+    
+    @staticmethod
+    def _countdown_interval(remaining: float) -> int:
+        """فاصله به‌روزرسانی: درشت در زمان زیاد، ریز نزدیک به انقضا"""
+        if remaining > 3600:
+            return 900
+        if remaining > 600:
+            return 300
+        if remaining > 120:
+            return 60
+        return 10
+    
+    async def _update_countdowns(self, now: float):
+        """به‌روزرسانی پیام هشدار تحویل‌های فعال در سقف بودجه ویرایش"""
+        if COUNTDOWN_MODE == 'static':
+            return
+        
+        pending = [
+            entry for entry in self.entries.values()
+            if entry['warning_id'] is not None
+            and entry.setdefault('next_update', now) <= now
+            and entry['due'] - now >= 1
+        ]
+        # قدیمی‌ترین به‌روزرسانی‌های عقب‌افتاده اول؛ بقیه در تیک بعدی
+        pending.sort(key=lambda entry: entry['next_update'])
+        budget = max(1, int(COUNTDOWN_EDIT_RATE * self.tick))
+        
+        edits = []
+        for entry in pending[:budget]:
+            remaining = round(entry['due'] - now)
+            entry['next_update'] = now + self._countdown_interval(remaining)
+            edits.append(self.bot.edit_message_text(
+                chat_id=entry['chat_id'],
+                message_id=entry['warning_id'],
+                text=f"⚠️ فایل‌ها بعد از {remaining} ثانیه حذف می‌شوند!\nزمان باقیمانده: {remaining} ثانیه"
+            ))
+        for result in await asyncio.gather(*edits, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.warning(f"خطا در به‌روزرسانی تایمر: {result}")
+
+class MembershipCache:
+    """کش LRU با TTL برای وضعیت عضویت کاربران در کانال‌ها"""
     
-    async def save_category_timer(self, category_id: str, seconds: int):
-        """ذخیره تایمر اختصاصی برای یک دسته"""
-        self.category_timers[category_id] = seconds
+    def __init__(self, max_size: int, ttl: int, negative_ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.data = OrderedDict()  # (user_id, channel_id) -> (is_member, expires)
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, user_id: int, channel_id):
+        """وضعیت ذخیره شده یا None در صورت نبود/انقضا"""
+        key = (user_id, channel_id)
+        item = self.data.get(key)
+        if item is None or item[1] <= time.monotonic():
+            if item is not None:
+                del self.data[key]
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+    
+    def set(self, user_id: int, channel_id, is_member: bool):
+        ttl = self.ttl if is_member else self.negative_ttl
+        key = (user_id, channel_id)
+        self.data[key] = (is_member, time.monotonic() + ttl)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+    
+    def invalidate_user(self, user_id: int):
+        """حذف نتایج منفی کاربر (مثلا پس از زدن دکمه «عضو شدم»)"""
+        for key in [k for k, v in self.data.items() if k[0] == user_id and not v[0]]:
+            del self.data[key]
+
+class ChannelRegistry:
+    """ثبت کانال‌های عضویت اجباری با ذخیره دائمی در لایه ذخیره‌سازی"""
+    
+    def __init__(self):
+        self.storage = None
+        self.channels = []  # [{'chat_id', 'title', 'link'}, ...]
+    
+    async def load(self, storage: StorageBackend, bot):
+        """بارگذاری یک‌باره لیست کانال‌ها و بررسی دسترسی ادمین ربات"""
+        self.storage = storage
+        self.channels = list(storage.required_channels)
+        if not self.channels and REQUIRED_CHANNELS:
+            # مقداردهی اولیه از تنظیمات محیطی
+            self.channels = self._parse_entries(REQUIRED_CHANNELS)
+            await storage.save_required_channels(self.channels)
         
-        # پیدا کردن پیام دسته و به‌روزرسانی آن
         for channel in self.channels:
-            try:
-                async for message in self.bot.get_chat_history(chat_id=channel, limit=100):
-                    if message.text and f"CATEGORY:{category_id}" in message.text:
-                        lines = message.text.split('\n')
-                        new_lines = []
-                        timer_found = False
-                        
-                        for line in lines:
-                            if line.startswith("TIMER:"):
-                                new_lines.append(f"TIMER:{seconds}")
-                                timer_found = True
-                            else:
-                                new_lines.append(line)
-                        
-                        if not timer_found:
-                            # اگر خط تایمر وجود نداشت، آن را اضافه کن
-                            for i, line in enumerate(new_lines):
-                                if line.startswith("CREATED_BY:"):
-                                    new_lines.insert(i + 1, f"TIMER:{seconds}")
-                                    break
-                        
-                        await message.edit_text('\n'.join(new_lines))
-                        return
-            except Exception as e:
-                logger.error(f"خطا در به‌روزرسانی تایمر دسته: {e}")
+            if not await self._bot_is_admin(bot, channel['chat_id']):
+                logger.warning(f"ربات در کانال {channel['chat_id']} ادمین نیست؛ بررسی عضویت ممکن نیست")
+        logger.info(f"{len(self.channels)} کانال اجباری بارگذاری شد")
     
-    async def _find_message_for_category(self, category_id: str = None):
-        """پیدا کردن پیام مناسب برای دسته"""
+    @staticmethod
+    def _parse_entries(entries: list) -> list:
+        """تبدیل تنظیمات کانال‌های اجباری به لیست {chat_id, title, link}"""
+        channels = []
+        for entry in entries:
+            chat_id, _, link = entry.partition('|')
+            if not link and chat_id.startswith('@'):
+                link = f"https://t.me/{chat_id[1:]}"
+            channels.append({'chat_id': chat_id, 'title': chat_id, 'link': link})
+        return channels
+    
+    @staticmethod
+    async def _bot_is_admin(bot, chat_id) -> bool:
+        try:
+            member = await bot.get_chat_member(chat_id=chat_id, user_id=bot.id)
+            return member.status in ['administrator', 'creator']
+        except Exception as e:
+            logger.warning(f"خطا در بررسی دسترسی ربات در {chat_id}: {e}")
+            return False
+    
+    def ids(self) -> list:
+        return [channel['chat_id'] for channel in self.channels]
+    
+    def find(self, chat_id) -> dict:
+        chat_id = str(chat_id)
         for channel in self.channels:
-            try:
-                async for message in self.bot.get_chat_history(chat_id=channel, limit=100):
-                    if message.text and message.text.startswith("CATEGORIES_BLOCK:"):
-                        categories = message.text.split('\n')[1:]
-                        
-                        for i, cat_line in enumerate(categories):
-                            if cat_line.startswith(f"CATEGORY:{category_id}" if category_id else "CATEGORY:"):
-                                return message, i, channel
-                        
-                        # اگر پیام پیدا شد اما جای خالی دارد
-                        if len(categories) < self.categories_per_message:
-                            return message, len(categories), channel
-            except Exception as e:
-                logger.error(f"خطا در جستجوی پیام دسته: {e}")
-        
-        return None, None, None
+            if channel['chat_id'] == chat_id:
+                return channel
+        return None
     
-    async def add_category(self, name: str, created_by: int) -> str:
-        """ایجاد دسته جدید"""
-        category_id = str(uuid.uuid4())[:8]
-        category_data = (
-            f"CATEGORY:{category_id}\n"
-            f"NAME:{name}\n"
-            f"CREATED_BY:{created_by}\n"
-            f"TIMER:{self.global_timer}\n"
-            "FILES:"
-        )
+    async def add(self, bot, chat_ref) -> dict:
+        """افزودن کانال پس از بررسی ادمین بودن ربات؛ در صورت خطا ValueError"""
+        try:
+            chat = await bot.get_chat(chat_ref)
+        except Exception as e:
+            raise ValueError(f"کانال یافت نشد: {e}")
         
-        message, pos, channel = await self._find_message_for_category()
+        if not await self._bot_is_admin(bot, chat.id):
+            raise ValueError("ربات باید در کانال ادمین باشد")
         
-        if message:
-            # افزودن به پیام موجود
-            lines = message.text.split('\n')
-            lines.insert(pos + 1, category_data)
-            
-            # بررسی اندازه پیام
-            new_text = '\n'.join(lines)
-            if len(new_text) <= 4096:
-                await self.bot.edit_message_text(
-                    chat_id=channel,
-                    message_id=message.message_id,
-                    text=new_text
-                )
-            else:
-                # اگر پیام پر شد، پیام جدید ایجاد کنید
-                message = None
+        if chat.username:
+            link = f"https://t.me/{chat.username}"
         else:
-            # پیام جدید ایجاد شود
-            message = None
-        
-        if not message:
-            new_text = f"CATEGORIES_BLOCK:\n{category_data}"
-            # چرخش بین کانال‌ها برای توزیع بار
-            channel = self.channels[self.current_channel_index]
-            self.current_channel_index = (self.current_channel_index + 1) % len(self.channels)
-            
-            await self.bot.send_message(
-                chat_id=channel,
-                text=new_text
-            )
-        
-        # ذخیره تایمر در کش
-        self.category_timers[category_id] = self.global_timer
+            link = chat.invite_link or await bot.export_chat_invite_link(chat.id)
         
-        return category_id
+        channel = {'chat_id': str(chat.id), 'title': chat.title or str(chat.id), 'link': link}
+        existing = self.find(chat.id)
+        channels = [c for c in self.channels if c is not existing] + [channel]
+        await self.storage.save_required_channels(channels)
+        self.channels = channels
+        return channel
     
-    async def get_categories(self) -> dict:
-        """دریافت تمام دسته‌ها"""
-        categories = {}
-        for channel in self.channels:
-            try:
-                async for message in self.bot.get_chat_history(chat_id=channel, limit=100):
-                    if message.text and message.text.startswith("CATEGORIES_BLOCK:"):
-                        for line in message.text.split('\n')[1:]:
-                            if line.startswith("CATEGORY:"):
-                                cat_id = line.split(':')[1]
-                                # خط بعدی نام دسته است
-                                name_line = message.text.split('\n')[message.text.split('\n').index(line) + 1]
-                                name = name_line.split(':')[1]
-                                categories[cat_id] = name
-            except Exception as e:
-                logger.error(f"خطا در دریافت دسته‌ها: {e}")
-        return categories
+    async def remove(self, chat_id) -> bool:
+        channel = self.find(chat_id)
+        if not channel:
+            return False
+        channels = [c for c in self.channels if c is not channel]
+        await self.storage.save_required_channels(channels)
+        self.channels = channels
+        return True
+
+class UploadSession:
+    """جلسه آپلود فایل ادمین"""
+    __slots__ = ('category_id', 'files', 'touched')
+    kind = 'upload'
     
-    async def get_category(self, category_id: str) -> dict:
-        """دریافت اطلاعات یک دسته"""
-        for channel in self.channels:
-            try:
-                async for message in self.bot.get_chat_history(chat_id=channel, limit=100):
-                    if message.text and f"CATEGORY:{category_id}" in message.text:
-                        lines = message.text.split('\n')
-                        
-                        # پیدا کردن موقعیت دسته
-                        start_idx = None
-                        for i, line in enumerate(lines):
-                            if line.startswith(f"CATEGORY:{category_id}"):
-                                start_idx = i
-                                break
-                        
-                        if start_idx is None:
-                            continue
-                        
-                        # استخراج اطلاعات
-                        name = lines[start_idx + 1].split(':')[1]
-                        
-                        # استخراج تایمر اگر وجود دارد
-                        timer = self.global_timer
-                        if lines[start_idx + 2].startswith("TIMER:"):
-                            try:
-                                timer = int(lines[start_idx + 2].split(':')[1])
-                            except (IndexError, ValueError):
-                                pass
-                        
-                        files = []
-                        file_lines = lines[start_idx + 4:]  # خطوط بعد از FILES:
-                        for line in file_lines:
-                            if line and not line.startswith("CATEGORY:"):
-                                file_data = line.split('|')
-                                if len(file_data) >= 2:
-                                    files.append({
-                                        'file_id': file_data[0],
-                                        'file_type': file_data[1],
-                                        'caption': file_data[2] if len(file_data) > 2 else ''
-                                    })
-                            else:
-                                break
-                        
-                        return {
-                            'name': name,
-                            'timer': timer,
-                            'files': files
-                        }
-            except Exception as e:
-                logger.error(f"خطا در دریافت اطلاعات دسته: {e}")
-        return None
+    def __init__(self, category_id: str, files: list = None, touched: float = None):
+        self.category_id = category_id
+        self.files = files if files is not None else []
+        self.touched = touched or time.time()
     
-    async def add_file(self, category_id: str, file_info: dict) -> bool:
-        """افزودن فایل به دسته"""
-        for channel in self.channels:
+    def dump(self) -> dict:
+        return {'category_id': self.category_id, 'files': self.files}
+
+class TimerSession:
+    """جلسه تنظیم تایمر اختصاصی دسته"""
+    __slots__ = ('category_id', 'touched')
+    kind = 'timer'
+    
+    def __init__(self, category_id: str, touched: float = None):
+        self.category_id = category_id
+        self.touched = touched or time.time()
+    
+    def dump(self) -> dict:
+        return {'category_id': self.category_id}
+
+class ChannelSession:
+    """جلسه انتظار برای اطلاعات کانال اجباری"""
+    __slots__ = ('touched',)
+    kind = 'channel'
+    
+    def __init__(self, touched: float = None):
+        self.touched = touched or time.time()
+    
+    def dump(self) -> dict:
+        return {}
+
+SESSION_TYPES = {cls.kind: cls for cls in (UploadSession, TimerSession, ChannelSession)}
+
+class SessionJournal:
+    """ذخیره پایدار جلسه‌های باز در SQLite"""
+    
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                kind TEXT NOT NULL,
+                user_id INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                touched REAL NOT NULL,
+                PRIMARY KEY (kind, user_id)
+            );
+        """)
+        self.conn.commit()
+    
+    def save(self, kind: str, user_id: int, session):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO sessions (kind, user_id, data, touched) VALUES (?, ?, ?, ?)",
+                (kind, user_id, json.dumps(session.dump(), ensure_ascii=False), session.touched)
+            )
+    
+    def remove(self, keys: list):
+        with self.conn:
+            self.conn.executemany("DELETE FROM sessions WHERE kind = ? AND user_id = ?", keys)
+    
+    def load(self) -> list:
+        """همه جلسه‌ها به ترتیب آخرین فعالیت: [(kind, user_id, data, touched), ...]"""
+        return [
+            (row[0], row[1], json.loads(row[2]), row[3])
+            for row in self.conn.execute("SELECT kind, user_id, data, touched FROM sessions ORDER BY touched")
+        ]
+
+class SessionStore:
+    """نگهداری جلسه‌های گفتگو با انقضای بیکاری و سقف حافظه"""
+    
+    def __init__(self, ttl: int, max_sessions: int, max_files: int):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_files = max_files
+        self.sessions = OrderedDict()  # (kind, user_id) -> session، به ترتیب آخرین فعالیت
+        self.journal = None
+        self.evicted = 0
+    
+    def start(self, journal: SessionJournal = None):
+        """بازیابی جلسه‌های ذخیره شده که هنوز منقضی نشده‌اند"""
+        self.journal = journal
+        if not journal:
+            return
+        try:
+            rows = journal.load()
+        except (sqlite3.Error, ValueError) as e:
+            logger.error(f"خطا در بازیابی جلسه‌ها: {e}")
+            return
+        for kind, user_id, data, touched in rows:
+            if kind in SESSION_TYPES:
+                self.sessions[(kind, user_id)] = SESSION_TYPES[kind](**data, touched=touched)
+        self._evict()
+        if self.sessions:
+            logger.info(f"{len(self.sessions)} جلسه باز بازیابی شد")
+    
+    def get(self, kind: str, user_id: int):
+        """جلسه فعال کاربر یا None"""
+        session = self.sessions.get((kind, user_id))
+        if session is not None and session.touched + self.ttl <= time.time():
+            self._drop([(kind, user_id)])
+            return None
+        return session
+    
+    def put(self, user_id: int, session):
+        """ثبت یا به‌روزرسانی جلسه و تمدید زمان انقضای آن"""
+        key = (session.kind, user_id)
+        session.touched = time.time()
+        self.sessions[key] = session
+        self.sessions.move_to_end(key)
+        if self.journal:
             try:
-                async for message in self.bot.get_chat_history(chat_id=channel, limit=100):
-                    if message.text and f"CATEGORY:{category_id}" in message.text:
-                        lines = message.text.split('\n')
-                        
-                        # پیدا کردن موقعیت FILES: برای این دسته
-                        files_idx = None
-                        for i, line in enumerate(lines):
-                            if line.startswith(f"CATEGORY:{category_id}"):
-                                # پیدا کردن خط FILES: بعد از این دسته
-                                for j in range(i, len(lines)):
-                                    if lines[j].startswith("FILES:"):
-                                        files_idx = j
-                                        break
-                                break
-                        
-                        if files_idx is None:
-                            continue
-                        
-                        # افزودن فایل جدید
-                        new_file_line = f"{file_info['file_id']}|{file_info['file_type']}|{file_info.get('caption', '')}"
-                        lines.insert(files_idx + 1, new_file_line)
-                        
-                        # بررسی اندازه پیام
-                        new_text = '\n'.join(lines)
-                        if len(new_text) > 4096:
-                            continue  # به پیام بعدی برو
-                        
-                        await message.edit_text(new_text)
-                        return True
-            except Exception as e:
-                logger.error(f"خطا در افزودن فایل: {e}")
-        return False
+                self.journal.save(session.kind, user_id, session)
+            except sqlite3.Error as e:
+                logger.error(f"خطا در ذخیره جلسه: {e}")
+        self._evict()
     
-    async def delete_category(self, category_id: str) -> bool:
-        """حذف یک دسته"""
-        for channel in self.channels:
+    def pop(self, kind: str, user_id: int):
+        """برداشتن جلسه فعال کاربر"""
+        session = self.get(kind, user_id)
+        if session is not None:
+            self._drop([(kind, user_id)])
+        return session
+    
+    def discard_user(self, user_id: int):
+        """حذف همه جلسه‌های یک کاربر"""
+        self._drop([key for key in ((kind, user_id) for kind in SESSION_TYPES) if key in self.sessions])
+    
+    def _evict(self):
+        """حذف جلسه‌های منقضی و قدیمی‌ترین‌ها در صورت عبور از سقف"""
+        expired = []
+        now = time.time()
+        for key, session in self.sessions.items():
+            if len(self.sessions) - len(expired) <= self.max_sessions and session.touched + self.ttl > now:
+                break
+            expired.append(key)
+        self.evicted += len(expired)
+        self._drop(expired)
+    
+    def _drop(self, keys: list):
+        for key in keys:
+            del self.sessions[key]
+        if self.journal and keys:
             try:
-                async for message in self.bot.get_chat_history(chat_id=channel, limit=100):
-                    if message.text and f"CATEGORY:{category_id}" in message.text:
-                        lines = message.text.split('\n')
-                        
-                        # پیدا کردن محدوده خطوط این دسته
-                        start_idx = None
-                        end_idx = None
-                        for i, line in enumerate(lines):
-                            if line.startswith(f"CATEGORY:{category_id}"):
-                                start_idx = i
-                            elif start_idx is not None and i > start_idx and line.startswith("CATEGORY:"):
-                                end_idx = i
-                                break
-                        
-                        if start_idx is None:
-                            continue
-                        
-                        # حذف خطوط مربوط به این دسته
-                        if end_idx:
-                            del lines[start_idx:end_idx]
-                        else:
-                            del lines[start_idx:]
-                        
-                        # حذف تایمر از کش
-                        if category_id in self.category_timers:
-                            del self.category_timers[category_id]
-                        
-                        # اگر پیام خالی شد، آن را حذف کنید
-                        if len(lines) <= 1:  # فقط خط CATEGORIES_BLOCK: باقی مانده
-                            await message.delete()
-                        else:
-                            await message.edit_text('\n'.join(lines))
-                        return True
-            except Exception as e:
-                logger.error(f"خطا در حذف دسته: {e}")
-        return False
+                self.journal.remove(keys)
+            except sqlite3.Error as e:
+                logger.error(f"خطا در پاکسازی جلسه‌ها: {e}")
 
 class BotManager:
     """مدیریت اصلی ربات"""
     
     def __init__(self):
         self.storage = None
-        self.pending_uploads = {}
-        self.pending_channels = {}
-        self.pending_timers = {}
+        self.sessions = SessionStore(SESSION_TTL, SESSION_MAX, SESSION_MAX_FILES)
+        self.plans = DeliveryPlanCache()
         self.bot_username = None
-        self.delete_tasks = {}
+        self.delivery = DeliveryEngine()
+        self.scheduler = DeletionScheduler(self.delivery)
+        self.membership_cache = MembershipCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_TTL, MEMBERSHIP_NEGATIVE_TTL)
+        self.channel_registry = ChannelRegistry()
+        
+        metrics.gauge('delivery_queue_depth', lambda: self.delivery.queue_depth, 'Sends waiting for or inside the delivery engine')
+        metrics.gauge('deletion_timers_active', lambda: self.scheduler.active_count, 'Deliveries waiting for auto-delete')
+        metrics.gauge('membership_cache_hit_ratio', lambda: self._hit_ratio(self.membership_cache), 'Membership cache hit ratio')
+        metrics.gauge('delivery_plan_hit_ratio', lambda: self._hit_ratio(self.plans), 'Delivery plan cache hit ratio')
+        metrics.gauge('membership_cache_size', lambda: len(self.membership_cache.data), 'Membership cache entries')
+        metrics.gauge('storage_dirty_messages', self._dirty_count, 'Storage messages with edits waiting for the flush window')
+        metrics.gauge('sessions_active', lambda: len(self.sessions.sessions), 'Open upload/timer/channel sessions')
+        metrics.gauge('sessions_evicted', lambda: self.sessions.evicted, 'Sessions evicted by idle TTL or memory cap')
+        metrics.gauge('active_deliveries', lambda: len(self.active_deliveries), 'Users with a delivery in flight')
+        self.active_deliveries = set()
     
     async def init(self, bot_username: str, bot):
         """راه‌اندازی اولیه"""
         self.bot_username = bot_username
-        self.storage = ChannelStorage(bot)
+        snapshot = HistorySnapshot(SCAN_STATE_DB) if SCAN_STATE_DB else None
+        if STORAGE_BACKEND == 'sqlite':
+            mirror = ChannelStorage(bot, snapshot) if STORAGE_CHANNELS and STORAGE_MIRROR else None
+            self.storage = SQLiteStorage(SQLITE_PATH, mirror)
+        else:
+            self.storage = ChannelStorage(bot, snapshot)
+        self._instrument_storage(self.storage)
+        self.plans.attach(self.storage)
         await self.storage.initialize()
+        await self.channel_registry.load(self.storage, bot)
+        self.scheduler.start(bot, DeletionJournal(DELETION_DB) if DELETION_DB else None)
+        self.sessions.start(SessionJournal(SESSION_DB) if SESSION_DB else None)
+    
+    @staticmethod
+    def _instrument_storage(storage: StorageBackend):
+        """ثبت زمان اجرای متدهای ذخیره‌سازی در metrics"""
+        metrics.instrument(storage, STORAGE_METHODS, 'storage_operation_seconds', backend=type(storage).__name__)
+        mirror = getattr(storage, 'mirror', None)
+        if mirror:
+            metrics.instrument(mirror, STORAGE_METHODS, 'storage_operation_seconds', backend=type(mirror).__name__)
+    
+    def _dirty_count(self) -> int:
+        storage = getattr(self.storage, 'mirror', None) or self.storage
+        return len(storage.dirty_messages()) if isinstance(storage, ChannelStorage) else 0
+    
+    async def close(self):
+        """نوشتن تغییرات در انتظار پیش از خاموش شدن"""
+        await self.scheduler.stop()
+        if self.storage:
+            written, failed = await self.storage.sync()
+            logger.info(f"Storage synced on shutdown ({written} written, {failed} failed)")
+    
+    @staticmethod
+    def _hit_ratio(cache) -> float:
+        total = cache.hits + cache.misses
+        return cache.hits / total if total else 0.0
     
     def is_admin(self, user_id: int) -> bool:
         """بررسی ادمین بودن کاربر"""
@@ -436,10 +2352,112 @@ class BotManager:
 # ایجاد نمونه
 bot_manager = BotManager()
 
+# ========================
+# ===== HTTP LAYER =======
+# ========================
+
+class HttpLayer:
+    """استخر اتصال aiohttp مشترک برای ربات و keep-alive"""
+    
+    def __init__(self):
+        self.session = None
+    
+    async def get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_SIZE,
+                limit_per_host=HTTP_POOL_SIZE,
+                keepalive_timeout=HTTP_KEEPALIVE,
+                ttl_dns_cache=300
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=HTTP_CONNECT_TIMEOUT,
+                    sock_read=HTTP_READ_TIMEOUT
+                )
+            )
+        return self.session
+    
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+
+class AiohttpRequest(BaseRequest):
+    """پیاده‌سازی BaseRequest روی استخر اتصال مشترک aiohttp"""
+    
+    def __init__(self, http: HttpLayer, read_timeout: float = HTTP_READ_TIMEOUT):
+        self.http = http
+        self._read_timeout = read_timeout
+    
+    @property
+    def read_timeout(self):
+        return self._read_timeout
+    
+    async def initialize(self):
+        await self.http.get_session()
+    
+    async def shutdown(self):
+        # نشست متعلق به HttpLayer است و هنگام خروج بسته می‌شود
+        pass
+    
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data=None,
+        read_timeout=BaseRequest.DEFAULT_NONE,
+        write_timeout=BaseRequest.DEFAULT_NONE,
+        connect_timeout=BaseRequest.DEFAULT_NONE,
+        pool_timeout=BaseRequest.DEFAULT_NONE,
+    ):
+        if read_timeout is BaseRequest.DEFAULT_NONE:
+            read_timeout = self._read_timeout
+        if connect_timeout is BaseRequest.DEFAULT_NONE:
+            connect_timeout = HTTP_CONNECT_TIMEOUT
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+        
+        data = None
+        if request_data:
+            if request_data.multipart_data:
+                data = aiohttp.FormData()
+                for name, value in request_data.json_parameters.items():
+                    data.add_field(name, value)
+                for name, (filename, content, mimetype) in request_data.multipart_data.items():
+                    data.add_field(name, content, filename=filename, content_type=mimetype)
+            else:
+                data = request_data.json_parameters
+        
+        endpoint = url.rsplit('/', 1)[-1]
+        metrics.inc('telegram_api_calls_total', method=endpoint)
+        started = time.perf_counter()
+        session = await self.http.get_session()
+        try:
+            async with session.request(method, url, data=data, timeout=timeout) as response:
+                payload = await response.read()
+        except asyncio.TimeoutError as e:
+            metrics.inc('telegram_api_errors_total', method=endpoint, reason='timeout')
+            raise TimedOut from e
+        except aiohttp.ClientError as e:
+            metrics.inc('telegram_api_errors_total', method=endpoint, reason='network')
+            raise NetworkError(f"aiohttp error: {e}") from e
+        finally:
+            metrics.observe('telegram_api_seconds', time.perf_counter() - started, method=endpoint)
+        
+        if response.status == 429:
+            metrics.inc('telegram_flood_events_total', method=endpoint)
+        elif response.status != 200:
+            metrics.inc('telegram_api_errors_total', method=endpoint, reason=str(response.status))
+        return response.status, payload
+
+http_layer = HttpLayer()
+
 # ========================
 # ==== HANDLER FUNCTIONS ===
 # ========================
 
+@metrics.track_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """نسخه اصلاح شده دستور شروع"""
     user_id = update.effective_user.id
@@ -465,25 +2483,41 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/add_channel - افزودن کانال اجباری\n"
             "/remove_channel - حذف کانال\n"
             "/channels - لیست کانال‌ها\n"
+            "/sync - ذخیره فوری تغییرات\n"
             f"/timer [زمان] - تنظیم تایمر جهانی (فعلی: {timer_status})"
         )
     else:
         await update.message.reply_text("👋 سلام! برای دریافت فایل‌ها از لینک‌ها استفاده کنید.")
 
 async def is_user_member(context, channel_id, user_id):
-    """بررسی عضویت کاربر با تلاش مجدد"""
-    for _ in range(3):  # 3 بار تلاش
+    """بررسی عضویت کاربر با کش و تلاش مجدد"""
+    cache = bot_manager.membership_cache
+    cached = cache.get(user_id, channel_id)
+    if cached is not None:
+        return cached
+    
+    for attempt in range(3):  # 3 بار تلاش
         try:
             member = await context.bot.get_chat_member(chat_id=channel_id, user_id=user_id)
-            if member.status in ['member', 'administrator', 'creator']:
-                return True
+            is_member = member.status in ['member', 'administrator', 'creator']
+            cache.set(user_id, channel_id, is_member)
+            return is_member
+        except RetryAfter as e:
+            metrics.inc('telegram_retry_after_total', source='membership')
+            await asyncio.sleep(e.retry_after)
         except Exception as e:
             logger.warning(f"خطا در بررسی عضویت: {e}")
-        
-        await asyncio.sleep(2)  # تاخیر 2 ثانیه‌ای بین هر تلاش
+            if attempt < 2:
+                # تاخیر نمایی با jitter
+                await asyncio.sleep(random.uniform(0, 0.5 * 2 ** attempt))
     
     return False
 
+async def get_missing_channels(context, channels: list, user_id: int) -> list:
+    """بررسی همزمان عضویت در همه کانال‌ها و برگرداندن کانال‌های عضو نشده"""
+    results = await asyncio.gather(*(is_user_member(context, channel, user_id) for channel in channels))
+    return [channel for channel, is_member in zip(channels, results) if not is_member]
+
 async def handle_category(update: Update, context: ContextTypes.DEFAULT_TYPE, category_id: str):
     """مدیریت دسترسی به دسته"""
     # استخراج user_id و message بسته به نوع update
@@ -502,8 +2536,40 @@ async def handle_category(update: Update, context: ContextTypes.DEFAULT_TYPE, ca
         await admin_category_menu(message, context, category_id)
         return
     
-    # بررسی عضویت در کانال‌ها
-    # (کد قبلی بدون تغییر)
+    # بررسی عضویت در کانال‌ها (از کش)
+    channels = bot_manager.channel_registry.channels
+    missing = await get_missing_channels(context, bot_manager.channel_registry.ids(), user_id)
+    if missing:
+        keyboard = [
+            [InlineKeyboardButton(f"📢 {c['title']}", url=c['link'])]
+            for c in channels if c['chat_id'] in missing and c['link']
+        ]
+        keyboard.append([InlineKeyboardButton("✅ عضو شدم", callback_data=f"check_{category_id}")])
+        await message.reply_text(
+            "🔒 برای دریافت فایل‌ها ابتدا در کانال‌های زیر عضو شوید:",
+            reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+    
+    # بررسی وجود دسته از کش برنامه ارسال (همین برنامه برای ارسال استفاده می‌شود)
+    plan = await bot_manager.plans.get(bot_manager.storage, category_id)
+    if not plan:
+        await message.reply_text("❌ دسته یافت نشد!")
+        return
+    
+    # جلوگیری از ارسال تکراری در کلیک‌های پشت سر هم
+    if user_id in bot_manager.active_deliveries:
+        await message.reply_text("⏳ فایل‌ها در حال ارسال هستند، لطفا صبر کنید.")
+        return
+    bot_manager.active_deliveries.add(user_id)
+    
+    async def deliver():
+        try:
+            await send_category_files(message, context, category_id, user_id, plan)
+        finally:
+            bot_manager.active_deliveries.discard(user_id)
+    
+    # ارسال در پس‌زمینه تا هندلر منتظر کل تحویل نماند
+    context.application.create_task(deliver(), update=update)
 
 async def admin_category_menu(message: Message, context: ContextTypes.DEFAULT_TYPE, category_id: str):
     """منوی مدیریت دسته برای ادمین"""
@@ -534,99 +2600,101 @@ async def admin_category_menu(message: Message, context: ContextTypes.DEFAULT_TY
         logger.error(f"خطا در منوی ادمین: {e}")
         await message.reply_text("❌ خطایی در نمایش منو رخ داد")
 
-async def send_category_files(message: Message, context: ContextTypes.DEFAULT_TYPE, category_id: str):
-    """ارسال فایل‌های یک دسته با سیستم تایمر"""
+async def send_category_files(message: Message, context: ContextTypes.DEFAULT_TYPE, category_id: str, user_id: int = None, plan: DeliveryPlan = None):
+    """ارسال فایل‌های یک دسته با سیستم تایمر (plan: برنامه آماده از هندلر فراخواننده)"""
     try:
         chat_id = message.chat_id
-        user_id = message.from_user.id if message.from_user else message.chat_id
+        if user_id is None:
+            user_id = message.from_user.id if message.from_user else message.chat_id
         
-        category = await bot_manager.storage.get_category(category_id)
-        if not category or not category['files']:
+        if plan is None:
+            plan = await bot_manager.plans.get(bot_manager.storage, category_id)
+        if not plan or not plan.file_count:
             await message.reply_text("❌ فایلی برای نمایش وجود ندارد!")
             return
         
-        # تعیین تایمر مناسب
-        timer = bot_manager.storage.get_category_timer(category_id)
+        timer = plan.timer
         
-        # ارسال فایل‌ها
+        # ارسال فایل‌ها طبق برنامه آماده (نرخ ارسال توسط موتور تحویل کنترل می‌شود)
+        delivery = bot_manager.delivery
         sent_messages = []
-        await message.reply_text(f"📤 ارسال فایل‌های '{category['name']}'...")
+        await delivery.send(chat_id, message.reply_text, plan.header)
         
-        for file in category['files']:
-            try:
-                send_func = {
-                    'document': context.bot.send_document,
-                    'photo': context.bot.send_photo,
-                    'video': context.bot.send_video,
-                    'audio': context.bot.send_audio
-                }.get(file['file_type'])
-                
-                if send_func:
-                    sent_msg = await send_func(
+        for media, sends in plan.batches:
+            if media:
+                try:
+                    sent_group = await delivery.send(
+                        chat_id,
+                        context.bot.send_media_group,
+                        chat_id=chat_id,
+                        media=list(media)
+                    )
+                    sent_messages.extend(msg.message_id for msg in sent_group)
+                    continue
+                except Exception as e:
+                    logger.error(f"ارسال آلبوم خطا، ارسال تکی: {e}")
+            
+            for method, field, file_id, caption in sends:
+                try:
+                    sent_msg = await delivery.send(
+                        chat_id,
+                        getattr(context.bot, method),
                         chat_id=chat_id,
-                        **{file['file_type']: file['file_id']},
-                        caption=file.get('caption', '')[:1024]
+                        **{field: file_id},
+                        caption=caption
                     )
                     sent_messages.append(sent_msg.message_id)
-                await asyncio.sleep(0.5)  # افزایش تاخیر برای جلوگیری از محدودیت
-            except Exception as e:
-                logger.error(f"ارسال فایل خطا: {e}")
-                await asyncio.sleep(2)
+                except Exception as e:
+                    logger.error(f"ارسال فایل خطا: {e}")
         
         # ارسال هشدار تایمر
         if timer > 0:
-            warning_msg = await message.reply_text(
-                f"⚠️ فایل‌ها بعد از {timer} ثانیه به صورت خودکار حذف خواهند شد!\n"
-                f"زمان باقیمانده: {timer} ثانیه"
-            )
+            warning_text = plan.warning
+            if warning_text is None:
+                # تاریخ و اختلاف با UTC تا زمان حذف برای کاربر در هر منطقه زمانی روشن باشد
+                expires_at = (datetime.now().astimezone() + timedelta(seconds=timer)).strftime('%Y-%m-%d %H:%M:%S UTC%z')
+                warning_text = (
+                    f"⚠️ فایل‌ها بعد از {timer} ثانیه به صورت خودکار حذف خواهند شد!\n"
+                    f"زمان حذف: {expires_at}"
+                )
+            warning_msg = await delivery.send(chat_id, message.reply_text, warning_text)
             sent_messages.append(warning_msg.message_id)
             
             # زمان‌بندی برای حذف خودکار
-            bot_manager.delete_tasks[user_id] = asyncio.create_task(delete_messages_after_delay(context, chat_id, sent_messages, timer))
+            bot_manager.scheduler.schedule(chat_id, sent_messages, timer, warning_msg.message_id, user_id)
         else:
-            await message.reply_text("✅ فایل‌ها با موفقیت ارسال شدند.")
+            await delivery.send(chat_id, message.reply_text, "✅ فایل‌ها با موفقیت ارسال شدند.")
     except Exception as e:
         logger.error(f"خطا در ارسال فایل‌ها: {e}")
         await message.reply_text("❌ خطایی در ارسال فایل‌ها رخ داد")
 
-async def delete_messages_after_delay(context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_ids: list, delay: int):
-    """نسخه اصلاح شده با مدیریت خطاهای بهتر"""
-    try:
-        remaining = delay
-        while remaining > 0:
-            await asyncio.sleep(min(10, remaining))
-            remaining -= 10
-            
-            try:
-                # به‌روزرسانی پیام هشدار
-                if message_ids:
-                    await context.bot.edit_message_text(
-                        chat_id=chat_id,
-                        message_id=message_ids[-1],
-                        text=f"⚠️ فایل‌ها بعد از {remaining} ثانیه حذف می‌شوند!\nزمان باقیمانده: {remaining} ثانیه"
-                    )
-            except Exception as e:
-                logger.warning(f"خطا در به‌روزرسانی تایمر: {e}")
-
-        # حذف پیام‌ها
-        for msg_id in message_ids:
-            try:
-                await context.bot.delete_message(
-                    chat_id=chat_id,
-                    message_id=msg_id
-                )
-            except Exception as e:
-                logger.warning(f"حذف پیام ناموفق: {e}")
-                
-    except asyncio.CancelledError:
-        logger.info("حذف پیام‌ها لغو شد")
-    except Exception as e:
-        logger.error(f"خطای غیرمنتظره در تایمر حذف: {e}")
+def build_media_groups(files: list) -> list:
+    """گروه‌بندی فایل‌های پشت سر هم و سازگار در آلبوم‌های حداکثر ۱۰ تایی"""
+    batches = []
+    current = []
+    current_group = None
+    for file in files:
+        group = INPUT_MEDIA.get(file['file_type'], (None, None))[1]
+        if group is None or group != current_group or len(current) >= MEDIA_GROUP_LIMIT:
+            if current:
+                batches.append(current)
+            current = []
+            current_group = group
+        current.append(file)
+        if group is None:
+            # نوع ناشناخته به صورت تکی ارسال می‌شود
+            batches.append(current)
+            current = []
+            current_group = None
+    if current:
+        batches.append(current)
+    return batches
 
 # ========================
 # ==== ADMIN COMMANDS ====
 # ========================
 
+@metrics.track_handler
 async def new_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ایجاد دسته جدید"""
     user_id = update.effective_user.id
@@ -648,6 +2716,7 @@ async def new_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"تایمر فعلی: {bot_manager.storage.global_timer} ثانیه\n"
         f"برای آپلود فایل:\n/upload {category_id}")
 
+@metrics.track_handler
 async def upload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """شروع آپلود فایل"""
     user_id = update.effective_user.id
@@ -665,10 +2734,7 @@ async def upload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ دسته یافت نشد!")
         return
     
-    bot_manager.pending_uploads[user_id] = {
-        'category_id': category_id,
-        'files': []
-    }
+    bot_manager.sessions.put(user_id, UploadSession(category_id))
     
     await update.message.reply_text(
         f"📤 حالت آپلود فعال شد! فایل‌ها را ارسال کنید.\n"
@@ -676,10 +2742,12 @@ async def upload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"برای لغو: /cancel")
     return UPLOADING
 
+@metrics.track_handler
 async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """پردازش فایل‌های ارسالی"""
     user_id = update.effective_user.id
-    if user_id not in bot_manager.pending_uploads:
+    upload = bot_manager.sessions.get('upload', user_id)
+    if upload is None:
         return
     
     file_info = bot_manager.extract_file_info(update)
@@ -687,40 +2755,57 @@ async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ نوع فایل پشتیبانی نمی‌شود!")
         return
     
-    upload = bot_manager.pending_uploads[user_id]
-    upload['files'].append(file_info)
+    if len(upload.files) >= bot_manager.sessions.max_files:
+        await update.message.reply_text(
+            f"❌ حداکثر {bot_manager.sessions.max_files} فایل در هر آپلود مجاز است. برای ذخیره: /finish_upload")
+        return
     
-    await update.message.reply_text(f"✅ فایل دریافت شد! (تعداد: {len(upload['files'])})")
+    # فقط فیلدهای لازم برای ذخیره نگهداری می‌شوند
+    upload.files.append({
+        'file_id': file_info['file_id'],
+        'file_name': file_info['file_name'],
+        'file_type': file_info['file_type'],
+        'caption': file_info['caption']
+    })
+    bot_manager.sessions.put(user_id, upload)
+    
+    await update.message.reply_text(f"✅ فایل دریافت شد! (تعداد: {len(upload.files)})")
 
+@metrics.track_handler
 async def finish_upload(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """پایان آپلود فایل‌ها"""
     user_id = update.effective_user.id
-    if user_id not in bot_manager.pending_uploads:
+    upload = bot_manager.sessions.pop('upload', user_id)
+    if upload is None:
         await update.message.reply_text("❌ هیچ آپلودی فعال نیست!")
         return ConversationHandler.END
     
-    upload = bot_manager.pending_uploads.pop(user_id)
-    if not upload['files']:
+    if not upload.files:
         await update.message.reply_text("❌ فایلی دریافت نشد!")
         return ConversationHandler.END
     
-    # افزودن فایل‌ها به ذخیره‌سازی
-    added_count = 0
-    for file in upload['files']:
-        if await bot_manager.storage.add_file(upload['category_id'], file):
-            added_count += 1
+    # افزودن گروهی فایل‌ها به ذخیره‌سازی
+    results = await bot_manager.storage.add_files(upload.category_id, upload.files)
+    added_count = sum(results)
+    failed = [file['file_name'] for file, ok in zip(upload.files, results) if not ok]
+    
+    link = bot_manager.generate_link(upload.category_id)
+    category = await bot_manager.storage.get_category(upload.category_id)
+    timer = bot_manager.storage.get_category_timer(upload.category_id)
     
-    link = bot_manager.generate_link(upload['category_id'])
-    category = await bot_manager.storage.get_category(upload['category_id'])
-    timer = bot_manager.storage.get_category_timer(upload['category_id'])
+    failed_info = ""
+    if failed:
+        failed_info = f"⚠️ {len(failed)} فایل ذخیره نشد:\n" + "\n".join(f"• {name}" for name in failed) + "\n\n"
     
     await update.message.reply_text(
         f"✅ {added_count} فایل با موفقیت ذخیره شد!\n\n"
+        f"{failed_info}"
         f"🔗 لینک دسته:\n{link}\n"
         f"📂 نام دسته: {category['name']}\n"
         f"⏱ تایمر حذف: {timer} ثانیه")
     return ConversationHandler.END
 
+@metrics.track_handler
 async def categories_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """نمایش لیست دسته‌ها"""
     if not bot_manager.is_admin(update.effective_user.id):
@@ -742,10 +2827,115 @@ async def categories_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message += f"\n⏱ تایمر جهانی: {bot_manager.storage.global_timer} ثانیه"
     await update.message.reply_text(message)
 
+# ========================
+# === CHANNEL COMMANDS ===
+# ========================
+
+@metrics.track_handler
+async def add_channel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """افزودن کانال عضویت اجباری"""
+    user_id = update.effective_user.id
+    if not bot_manager.is_admin(user_id):
+        await update.message.reply_text("❌ دسترسی ممنوع!")
+        return ConversationHandler.END
+    
+    if context.args:
+        await _register_channel(update, context, context.args[0])
+        return ConversationHandler.END
+    
+    bot_manager.sessions.put(user_id, ChannelSession())
+    await update.message.reply_text(
+        "📢 یوزرنیم یا آیدی کانال را ارسال کنید یا یک پیام از کانال فوروارد کنید.\n"
+        "برای لغو: /cancel")
+    return WAITING_CHANNEL_INFO
+
+@metrics.track_handler
+async def handle_channel_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """دریافت اطلاعات کانال برای افزودن"""
+    user_id = update.effective_user.id
+    if bot_manager.sessions.get('channel', user_id) is None:
+        return ConversationHandler.END
+    
+    message = update.message
+    if message.forward_from_chat:
+        chat_ref = message.forward_from_chat.id
+    else:
+        chat_ref = (message.text or '').strip()
+    
+    if not chat_ref:
+        await message.reply_text("❌ لطفا یوزرنیم، آیدی یا پیام فوروارد شده از کانال را ارسال کنید.")
+        return WAITING_CHANNEL_INFO
+    
+    bot_manager.sessions.pop('channel', user_id)
+    await _register_channel(update, context, chat_ref)
+    return ConversationHandler.END
+
+async def _register_channel(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_ref):
+    try:
+        channel = await bot_manager.channel_registry.add(context.bot, chat_ref)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    except (TelegramError, sqlite3.Error) as e:
+        # ساخت لینک دعوت یا ذخیره لیست کانال‌ها ناموفق بود
+        logger.error(f"خطا در افزودن کانال {chat_ref}: {e}")
+        await update.message.reply_text(f"❌ خطا در افزودن کانال: {e}")
+        return
+    await update.message.reply_text(f"✅ کانال '{channel['title']}' به لیست عضویت اجباری اضافه شد.")
+
+@metrics.track_handler
+async def remove_channel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """حذف کانال عضویت اجباری"""
+    if not bot_manager.is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ دسترسی ممنوع!")
+        return
+    
+    if not context.args:
+        await update.message.reply_text("لطفا آیدی کانال را مشخص کنید.\nمثال: /remove_channel -1001234567890")
+        return
+    
+    if await bot_manager.channel_registry.remove(context.args[0]):
+        await update.message.reply_text("✅ کانال حذف شد.")
+    else:
+        await update.message.reply_text("❌ کانال در لیست نیست!")
+
+@metrics.track_handler
+async def channels_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """نمایش کانال‌های عضویت اجباری"""
+    if not bot_manager.is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ دسترسی ممنوع!")
+        return
+    
+    channels = bot_manager.channel_registry.channels
+    if not channels:
+        await update.message.reply_text("📢 هیچ کانال اجباری ثبت نشده است!")
+        return
+    
+    message = "📢 کانال‌های عضویت اجباری:\n\n"
+    for channel in channels:
+        message += f"• {channel['title']} [ID: {channel['chat_id']}]\n"
+        if channel['link']:
+            message += f"  لینک: {channel['link']}\n"
+    await update.message.reply_text(message)
+
+@metrics.track_handler
+async def sync_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """نوشتن فوری تغییرات بافر شده در کانال ذخیره‌سازی"""
+    if not bot_manager.is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ دسترسی ممنوع!")
+        return
+    
+    written, failed = await bot_manager.storage.sync()
+    if failed:
+        await update.message.reply_text(f"⚠️ {written} پیام همگام شد، {failed} پیام ناموفق بود.")
+    else:
+        await update.message.reply_text(f"✅ همگام‌سازی انجام شد ({written} پیام).")
+
 # ========================
 # === TIMER MANAGEMENT ===
 # ========================
 
+@metrics.track_handler
 async def set_timer_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """تنظیم تایمر جهانی"""
     user_id = update.effective_user.id
@@ -771,6 +2961,7 @@ async def set_timer_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # === BUTTON HANDLERS ====
 # ========================
 
+@metrics.track_handler
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """مدیریت کلیک روی دکمه‌ها"""
     query = update.callback_query
@@ -778,6 +2969,12 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     user_id = query.from_user.id
     
+    # بررسی مجدد عضویت برای کاربران عادی
+    if data.startswith('check_'):
+        bot_manager.membership_cache.invalidate_user(user_id)
+        await handle_category(update, context, data[6:])
+        return
+    
     # دستورات ادمین
     if not bot_manager.is_admin(user_id):
         await query.edit_message_text("❌ دسترسی ممنوع!")
@@ -785,14 +2982,11 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if data.startswith('view_'):
         category_id = data[5:]
-        await send_category_files(query.message, context, category_id)
+        await send_category_files(query.message, context, category_id, user_id)
     
     elif data.startswith('add_'):
         category_id = data[4:]
-        bot_manager.pending_uploads[user_id] = {
-            'category_id': category_id,
-            'files': []
-        }
+        bot_manager.sessions.put(user_id, UploadSession(category_id))
         await query.edit_message_text(
             "📤 فایل‌ها را ارسال کنید.\n"
             "برای پایان: /finish_upload\n"
@@ -800,7 +2994,7 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     elif data.startswith('timer_'):
         category_id = data[6:]
-        bot_manager.pending_timers[user_id] = category_id
+        bot_manager.sessions.put(user_id, TimerSession(category_id))
         await query.edit_message_text(
             "⏱ لطفا زمان تایمر را به ثانیه وارد کنید (0 برای غیرفعال کردن):\n"
             f"تایمر فعلی: {bot_manager.storage.get_category_timer(category_id)} ثانیه\n"
@@ -814,13 +3008,15 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await query.edit_message_text("❌ خطا در حذف دسته!")
 
+@metrics.track_handler
 async def handle_category_timer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """پردازش تایمر اختصاصی دسته"""
     user_id = update.effective_user.id
-    if user_id not in bot_manager.pending_timers:
+    session = bot_manager.sessions.get('timer', user_id)
+    if session is None:
         return ConversationHandler.END
     
-    category_id = bot_manager.pending_timers[user_id]
+    category_id = session.category_id
     text = update.message.text.strip()
     
     try:
@@ -835,7 +3031,7 @@ async def handle_category_timer(update: Update, context: ContextTypes.DEFAULT_TY
             f"✅ تایمر دسته '{category['name']}' بر روی {seconds} ثانیه تنظیم شد.\n"
             f"این تنظیم فقط برای این دسته اعمال می‌شود.")
         
-        del bot_manager.pending_timers[user_id]
+        bot_manager.sessions.pop('timer', user_id)
         return ConversationHandler.END
     except ValueError:
         await update.message.reply_text("❌ لطفا یک عدد صحیح وارد کنید.")
@@ -845,20 +3041,14 @@ async def handle_category_timer(update: Update, context: ContextTypes.DEFAULT_TY
 # === UTILITY HANDLERS ===
 # ========================
 
+@metrics.track_handler
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """لغو عملیات جاری"""
     user_id = update.effective_user.id
-    if user_id in bot_manager.pending_uploads:
-        del bot_manager.pending_uploads[user_id]
-    if user_id in bot_manager.pending_channels:
-        del bot_manager.pending_channels[user_id]
-    if user_id in bot_manager.pending_timers:
-        del bot_manager.pending_timers[user_id]
-    
-    # لغو هرگونه وظیفه حذف در حال انتظار
-    if user_id in bot_manager.delete_tasks:
-        bot_manager.delete_tasks[user_id].cancel()
-        del bot_manager.delete_tasks[user_id]
+    bot_manager.sessions.discard_user(user_id)
+    
+    # لغو هرگونه حذف در حال انتظار
+    bot_manager.scheduler.cancel_user(user_id)
     
     await update.message.reply_text("❌ عملیات لغو شد.")
     return ConversationHandler.END
@@ -871,25 +3061,66 @@ async def health_check(request):
     """صفحه سلامت برای بررسی وضعیت ربات"""
     return web.Response(text="🤖 Telegram Bot is Running!")
 
+async def metrics_handler(request):
+    """خروجی metrics با قالب متنی Prometheus"""
+    return web.Response(
+        body=metrics.render().encode('utf-8'),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
 async def keep_alive():
     """نسخه اصلاح شده تابع keep_alive"""
     while True:
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get("improved-robot-production.up.railway.app") as resp:
-                    if resp.status == 200:
-                        logger.info("✅ Keep-alive ping sent successfully")
-                    else:
-                        logger.warning(f"⚠️ Keep-alive failed: {resp.status}")
+            session = await http_layer.get_session()
+            async with session.get(KEEP_ALIVE_URL) as resp:
+                if resp.status == 200:
+                    logger.info("✅ Keep-alive ping sent successfully")
+                else:
+                    logger.warning(f"⚠️ Keep-alive failed: {resp.status}")
         except Exception as e:
             logger.warning(f"⚠️ Keep-alive exception: {e}")
         
         await asyncio.sleep(300)  # هر 5 دقیقه
 
-async def run_web_server():
-    """اجرای سرور وب ساده"""
+class WebhookReceiver:
+    """دریافت آپدیت‌های webhook و ارسال به صف آپدیت ربات"""
+    
+    def __init__(self, secret: str):
+        self.secret = secret
+        self.application = None
+    
+    async def handle(self, request):
+        if self.application is None:
+            return web.Response(status=503)
+        
+        # اعتبارسنجی توکن مخفی ارسالی تلگرام
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not secrets.compare_digest(token, self.secret):
+            return web.Response(status=403)
+        
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except Exception as e:
+            # پاسخ 5xx باعث ارسال دوباره همین آپدیت توسط تلگرام می‌شود
+            logger.error(f"آپدیت webhook نامعتبر: {e}")
+            return web.Response(status=400)
+        
+        if update:
+            await self.application.update_queue.put(update)
+        return web.Response()
+
+def create_web_app(webhook: WebhookReceiver) -> web.Application:
+    """ساخت اپ وب مشترک برای سلامت و webhook"""
     app = web.Application()
     app.router.add_get('/health', health_check)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_post(WEBHOOK_PATH, webhook.handle)
+    return app
+
+async def run_web_server(app: web.Application):
+    """اجرای سرور وب"""
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', 10000)
@@ -904,9 +3135,59 @@ async def run_web_server():
 # ==== BOT SETUP =========
 # ========================
 
-async def run_telegram_bot():
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """پردازش همزمان آپدیت‌ها با حفظ ترتیب آپدیت‌های هر کاربر"""
+    
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self.user_locks = {}  # user/chat id -> [lock, waiters]
+    
+    @staticmethod
+    def _ordering_key(update):
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+    
+    async def process_update(self, update, coroutine):
+        key = self._ordering_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+        
+        # قفل کاربر قبل از گرفتن ظرفیت همزمانی، تا آپدیت‌های صف‌شده یک کاربر ظرفیت را اشغال نکنند
+        entry = self.user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.user_locks[key]
+    
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+
+async def run_telegram_bot(webhook: WebhookReceiver):
     """اجرای اصلی ربات تلگرام - نسخه اصلاح شده"""
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(AiohttpRequest(http_layer))
+        .get_updates_request(AiohttpRequest(http_layer))
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        .build()
+    )
     
     # دریافت یوزرنیم ربات
     bot = await application.bot.get_me()
@@ -919,6 +3200,21 @@ async def run_telegram_bot():
     application.add_handler(CommandHandler("new_category", new_category))
     application.add_handler(CommandHandler("categories", categories_list))
     application.add_handler(CommandHandler("timer", set_timer_command))
+    application.add_handler(CommandHandler("remove_channel", remove_channel_command))
+    application.add_handler(CommandHandler("channels", channels_list))
+    application.add_handler(CommandHandler("sync", sync_command))
+    
+    # افزودن کانال اجباری
+    channel_handler = ConversationHandler(
+        entry_points=[CommandHandler("add_channel", add_channel_command)],
+        states={
+            WAITING_CHANNEL_INFO: [
+                MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.FORWARDED, handle_channel_info)
+            ]
+        },
+        fallbacks=[CommandHandler("cancel", cancel)]
+    )
+    application.add_handler(channel_handler)
     
     # آپلود فایل‌ها
     upload_handler = ConversationHandler(
@@ -937,6 +3233,12 @@ async def run_telegram_bot():
         ]
     )
     application.add_handler(upload_handler)
+    # ادامه جلسه‌های آپلود بازیابی شده پس از راه‌اندازی مجدد (خارج از وضعیت ConversationHandler)
+    application.add_handler(MessageHandler(
+        filters.Document.ALL | filters.PHOTO | filters.VIDEO | filters.AUDIO,
+        handle_file
+    ))
+    application.add_handler(CommandHandler("finish_upload", finish_upload))
     
     # مدیریت تایمرهای اختصاصی
     timer_handler = ConversationHandler(
@@ -960,16 +3262,54 @@ async def run_telegram_bot():
     
     # نگه داشتن ربات در حالت اجرا
     async with application:
-        await application.updater.start_polling()
-        while True:
-            await asyncio.sleep(3600)
+        try:
+            if WEBHOOK_URL:
+                # آپدیت‌ها از طریق سرور وب مشترک وارد update_queue می‌شوند
+                webhook.application = application
+                await application.bot.set_webhook(
+                    url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES
+                )
+                logger.info("Webhook mode enabled")
+            else:
+                await application.updater.start_polling()
+            while True:
+                await asyncio.sleep(3600)
+        finally:
+            # توقف دریافت آپدیت‌ها و هندلرها پیش از shutdown (برنامه در حال اجرا قابل shutdown نیست)
+            if application.updater and application.updater.running:
+                await application.updater.stop()
+            if application.running:
+                await application.stop()
+            # نوشتن تغییرات بافر شده پس از توقف هندلرها
+            await bot_manager.close()
+
+async def run_together(*coros):
+    """اجرای همزمان coroutineها؛ در لغو یا خطا تا پایان پاکسازی همه منتظر می‌ماند
+
+    gather با لغو اولین فرزند برمی‌گردد و finally بقیه (توقف ربات و همگام‌سازی) نیمه‌کاره می‌ماند.
+    """
+    tasks = [asyncio.ensure_future(coro) for coro in coros]
+    try:
+        await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        # لغو از طریق gather به همه وظایف رسیده است
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    except Exception:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
 
 async def main():
     """تابع اصلی اجرا - نسخه اصلاح شده"""
-    # اجرای همزمان سرور وب و ربات تلگرام
-    await asyncio.gather(
-        run_web_server(),
-        run_telegram_bot()
+    # اجرای همزمان سرور وب و ربات تلگرام روی یک اپ مشترک
+    webhook = WebhookReceiver(WEBHOOK_SECRET)
+    await run_together(
+        run_web_server(create_web_app(webhook)),
+        run_telegram_bot(webhook)
     )
 
 if __name__ == '__main__':
@@ -977,15 +3317,25 @@ if __name__ == '__main__':
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     
+    # اجرای همزمان keep-alive و main
+    main_task = loop.create_task(run_together(keep_alive(), main()))
+    try:
+        # توقف مرتب هنگام SIGTERM (استقرار مجدد) تا تغییرات بافر شده نوشته شوند
+        loop.add_signal_handler(signal.SIGTERM, main_task.cancel)
+    except (NotImplementedError, AttributeError):
+        pass
+    
     try:
-        # اجرای همزمان keep-alive و main
-        loop.run_until_complete(asyncio.gather(
-            keep_alive(),
-            main()
-        ))
-    except KeyboardInterrupt:
-        logger.info("Bot stopped by user")
+        loop.run_until_complete(main_task)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logger.info("Bot stopped")
     except Exception as e:
         logger.exception(f"Critical error: {e}")
     finally:
+        if not main_task.done():
+            # Ctrl+C: اجرای پاکسازی وظایف پیش از بستن loop
+            main_task.cancel()
+            loop.run_until_complete(asyncio.gather(main_task, return_exceptions=True))
+        loop.run_until_complete(bot_manager.close())
+        loop.run_until_complete(http_layer.close())
         loop.close()
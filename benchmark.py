@@ -0,0 +1,448 @@
+"""بنچمارک آفلاین ربات با یک Bot API جعلی محلی
+
+یک سرور aiohttp رفتار Bot API تلگرام (تاخیر، محدودیت flood و ذخیره پیام‌ها
+به همراه تاریخچه چت) را شبیه‌سازی می‌کند و عملیات ذخیره‌سازی، ارسال فایل‌ها،
+finish_upload و انقضای تایمرها را با همزمانی قابل تنظیم اجرا می‌کند.
+
+اجرا:
+    python benchmark.py --concurrency 50 --operations 500 --latency 0.03
+"""
+import os
+import sys
+import json
+import time
+import math
+import random
+import asyncio
+import argparse
+import itertools
+from types import SimpleNamespace
+
+from aiohttp import web
+
+BENCH_TOKEN = '123456:BENCHMARK'
+ADMIN_ID = 1
+STORAGE_CHAT_IDS = ['-1001', '-1002', '-1003']
+
+# تنظیمات ربات باید قبل از import ماژول اصلی اعمال شوند
+os.environ.update({
+    'BOT_TOKEN': BENCH_TOKEN,
+    'ADMIN_IDS': str(ADMIN_ID),
+    'STORAGE_CHANNELS': ','.join(STORAGE_CHAT_IDS),
+    'STORAGE_BACKEND': 'channel',
+    'REQUIRED_CHANNELS': '',
+    'DELETION_DB': '',
+    'SESSION_DB': '',
+    'SCAN_STATE_DB': '',
+})
+
+from telegram import Bot, Message, Update  # noqa: E402
+
+import TelegramIploaderbot as botmod  # noqa: E402
+
+
+class FakeBotAPI:
+    """شبیه‌ساز Bot API با تاخیر، محدودیت flood و ذخیره پیام"""
+
+    def __init__(self, latency: float, chat_rate: float, global_rate: float):
+        self.latency = latency
+        self.chat_rate = chat_rate
+        self.global_rate = global_rate
+        self.chats = {}  # chat_id -> {message_id: message dict}
+        self.message_ids = itertools.count(1)
+        self.chat_buckets = {}
+        self.global_bucket = [global_rate, time.monotonic()]
+        self.calls = {}
+        self.flood_events = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    # ---- محدودیت flood ----
+
+    @staticmethod
+    def _take(bucket: list, rate: float) -> float:
+        """برداشت یک توکن؛ زمان انتظار لازم در صورت خالی بودن"""
+        now = time.monotonic()
+        bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        return (1 - bucket[0]) / rate
+
+    def _flood_wait(self, chat_id) -> float:
+        wait = self._take(self.global_bucket, self.global_rate)
+        if chat_id is not None:
+            bucket = self.chat_buckets.setdefault(chat_id, [self.chat_rate, time.monotonic()])
+            wait = max(wait, self._take(bucket, self.chat_rate))
+        return wait
+
+    # ---- ابزارها ----
+
+    @staticmethod
+    async def _params(request) -> dict:
+        if request.content_type == 'application/json':
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            if isinstance(value, str):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            params[key] = value
+        return params
+
+    def _store(self, chat_id, **fields) -> dict:
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'channel' if int(chat_id) < 0 else 'private'},
+            **fields
+        }
+        self.chats.setdefault(int(chat_id), {})[message['message_id']] = message
+        return message
+
+    @staticmethod
+    def _ok(result) -> web.Response:
+        return web.json_response({'ok': True, 'result': result})
+
+    @staticmethod
+    def _error(code: int, description: str, **parameters) -> web.Response:
+        body = {'ok': False, 'error_code': code, 'description': description}
+        if parameters:
+            body['parameters'] = parameters
+        return web.json_response(body, status=code)
+
+    # ---- متدها ----
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        params = await self._params(request)
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        await asyncio.sleep(random.uniform(self.latency * 0.5, self.latency * 1.5))
+
+        chat_id = params.get('chat_id')
+        if method.startswith(('send', 'edit', 'delete')):
+            wait = self._flood_wait(chat_id)
+            if wait > 0:
+                self.flood_events += 1
+                retry_after = max(1, math.ceil(wait))
+                return self._error(429, f"Too Many Requests: retry after {retry_after}", retry_after=retry_after)
+
+        handler = getattr(self, f"api_{method}", None)
+        if handler is None:
+            return self._error(400, f"Bad Request: method {method} not supported by the fake API")
+        return await handler(params)
+
+    async def api_getMe(self, params):
+        return self._ok({'id': 42, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'})
+
+    async def api_sendMessage(self, params):
+        return self._ok(self._store(params['chat_id'], text=str(params['text'])))
+
+    async def api_editMessageText(self, params):
+        message = self.chats.get(int(params['chat_id']), {}).get(int(params['message_id']))
+        if message is None:
+            return self._error(400, "Bad Request: message to edit not found")
+        message['text'] = str(params['text'])
+        return self._ok(message)
+
+    async def api_deleteMessage(self, params):
+        removed = self.chats.get(int(params['chat_id']), {}).pop(int(params['message_id']), None)
+        if removed is None:
+            return self._error(400, "Bad Request: message to delete not found")
+        return self._ok(True)
+
+    async def api_deleteMessages(self, params):
+        chat = self.chats.get(int(params['chat_id']), {})
+        for message_id in params['message_ids']:
+            chat.pop(int(message_id), None)
+        return self._ok(True)
+
+    async def _send_file(self, params, file_type):
+        return self._ok(self._store(
+            params['chat_id'],
+            caption=str(params.get('caption', '')),
+            document={'file_id': str(params[file_type]), 'file_unique_id': str(params[file_type])[:16]}
+        ))
+
+    async def api_sendDocument(self, params):
+        return await self._send_file(params, 'document')
+
+    async def api_sendPhoto(self, params):
+        return await self._send_file(params, 'photo')
+
+    async def api_sendVideo(self, params):
+        return await self._send_file(params, 'video')
+
+    async def api_sendAudio(self, params):
+        return await self._send_file(params, 'audio')
+
+    async def api_sendMediaGroup(self, params):
+        return self._ok([
+            self._store(params['chat_id'], caption=str(item.get('caption', '')))
+            for item in params['media']
+        ])
+
+    async def api_getChatMember(self, params):
+        return self._ok({
+            'status': 'administrator' if int(params['user_id']) == 42 else 'member',
+            'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'user'},
+            'can_be_edited': False, 'is_anonymous': False, 'can_manage_chat': True,
+            'can_delete_messages': True, 'can_manage_video_chats': True, 'can_restrict_members': True,
+            'can_promote_members': False, 'can_change_info': True, 'can_invite_users': True,
+        })
+
+    async def api_getChatHistory(self, params):
+        """متد غیراستاندارد: پیام‌های چت از جدید به قدیم"""
+        chat = self.chats.get(int(params['chat_id']), {})
+        offset_id = int(params.get('offset_id') or 0)
+        limit = int(params.get('limit') or 0)
+        ids = sorted((mid for mid in chat if not offset_id or mid < offset_id), reverse=True)
+        if limit:
+            ids = ids[:limit]
+        return self._ok([chat[mid] for mid in ids])
+
+    async def api_getMessages(self, params):
+        """متد غیراستاندارد: دریافت پیام‌ها با شناسه"""
+        chat = self.chats.get(int(params['chat_id']), {})
+        return self._ok([chat[int(mid)] for mid in params['message_ids'] if int(mid) in chat])
+
+
+class BenchBot(Bot):
+    """ربات PTB با متدهای تاریخچه‌ای که ChannelStorage استفاده می‌کند"""
+
+    async def get_chat_history(self, chat_id, limit: int = 0, offset_id: int = 0):
+        # صفحه‌بندی ۱۰۰تایی مانند کلاینت‌های MTProto
+        remaining = limit
+        while True:
+            page_size = min(100, remaining) if limit else 100
+            result = await self._post(
+                'getChatHistory',
+                data={'chat_id': chat_id, 'limit': page_size, 'offset_id': offset_id}
+            )
+            if not result:
+                return
+            for data in result:
+                yield Message.de_json(data, self)
+            offset_id = result[-1]['message_id']
+            if limit:
+                remaining -= len(result)
+                if remaining <= 0:
+                    return
+            if len(result) < page_size:
+                return
+
+    async def get_messages(self, chat_id, message_ids: list):
+        result = await self._post('getMessages', data={'chat_id': chat_id, 'message_ids': list(message_ids)})
+        return [Message.de_json(data, self) for data in result]
+
+
+# ---- اجرای سناریوها ----
+
+def percentile(values: list, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+async def measure(name: str, operations: int, concurrency: int, op) -> dict:
+    """اجرای op به تعداد operations با همزمانی محدود و گزارش تاخیر"""
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(i):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await op(i)
+            except Exception as e:
+                errors += 1
+                botmod.logger.warning(f"[{name}] خطا: {e}")
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_one(i) for i in range(operations)))
+    elapsed = time.perf_counter() - started
+    return {
+        'scenario': name,
+        'operations': operations,
+        'concurrency': concurrency,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'throughput': round(operations / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def fake_file(i: int) -> dict:
+    file_type = random.choice(['document', 'photo', 'video', 'audio'])
+    return {
+        'file_id': f"BQACAgQAAxkBAAI{i:08d}" + ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=40)),
+        'file_name': f"file_{i}",
+        'file_size': 1024,
+        'file_type': file_type,
+        'caption': random.choice(['', 'کپشن نمونه', f"file {i}"])
+    }
+
+
+def private_message(bot, chat_id: int, text: str = '/start') -> Message:
+    return Message.de_json({
+        'message_id': 1,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'user'},
+        'text': text
+    }, bot)
+
+
+async def run_benchmarks(args) -> list:
+    fake = FakeBotAPI(args.latency, args.flood_chat_rate, args.flood_global_rate)
+    runner = web.AppRunner(fake.app())
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', args.port)
+    await site.start()
+
+    bot = BenchBot(
+        BENCH_TOKEN,
+        base_url=f"http://127.0.0.1:{args.port}/bot",
+        request=botmod.AiohttpRequest(botmod.http_layer)
+    )
+    await bot.initialize()
+    await botmod.bot_manager.init(bot.username, bot)
+    storage = botmod.bot_manager.storage
+    context = SimpleNamespace(bot=bot, application=None)
+    results = []
+
+    try:
+        # ساخت دسته‌ها
+        category_ids = []
+
+        async def add_category(i):
+            category_ids.append(await storage.add_category(f"bench {i}", ADMIN_ID))
+        results.append(await measure('storage.add_category', args.categories, args.concurrency, add_category))
+
+        async def add_files(i):
+            files = [fake_file(i * 100 + j) for j in range(args.files_per_category)]
+            await storage.add_files(category_ids[i % len(category_ids)], files)
+        results.append(await measure('storage.add_files', len(category_ids), args.concurrency, add_files))
+
+        async def get_category(i):
+            await storage.get_category(random.choice(category_ids))
+        results.append(await measure('storage.get_category', args.operations, args.concurrency, get_category))
+
+        # ارسال فایل‌های دسته به کاربران مختلف
+        async def send_files(i):
+            chat_id = 10_000 + i
+            category_id = random.choice(category_ids)
+            expected = len((await storage.get_category(category_id))['files'])
+            message = private_message(bot, chat_id)
+            await botmod.send_category_files(message, context, category_id, chat_id)
+            # send_category_files خطاها را خودش ثبت می‌کند؛ تحویل از روی پیام‌های API جعلی بررسی می‌شود
+            delivered = sum(1 for msg in fake.chats.get(chat_id, {}).values() if 'caption' in msg)
+            if delivered != expected:
+                raise RuntimeError(f"{delivered}/{expected} فایل به {chat_id} تحویل شد")
+        results.append(await measure('send_category_files', args.deliveries, args.concurrency, send_files))
+
+        # پایان آپلود توسط ادمین
+        async def finish_upload(i):
+            update = Update.de_json({
+                'update_id': i,
+                'message': {
+                    'message_id': i + 1,
+                    'date': int(time.time()),
+                    'chat': {'id': ADMIN_ID, 'type': 'private'},
+                    'from': {'id': ADMIN_ID, 'is_bot': False, 'first_name': 'admin'},
+                    'text': '/finish_upload'
+                }
+            }, bot)
+            # آپلودها پشت سر هم توسط یک ادمین انجام می‌شوند
+            botmod.bot_manager.sessions.put(ADMIN_ID, botmod.UploadSession(
+                random.choice(category_ids),
+                [fake_file(i * 1000 + j) for j in range(args.files_per_category)]
+            ))
+            await botmod.finish_upload(update, context)
+        results.append(await measure('finish_upload', args.uploads, 1, finish_upload))
+
+        # انقضای تایمرها
+        scheduler = botmod.bot_manager.scheduler
+        expiry_chats = [20_000 + i for i in range(args.expiries)]
+        for chat_id in expiry_chats:
+            message_ids = [fake._store(chat_id, text='x')['message_id'] for _ in range(args.files_per_category)]
+            scheduler.schedule(chat_id, message_ids, 0, None, chat_id)
+        started = time.perf_counter()
+        deadline = started + args.expiry_timeout
+        # پایان زمانی است که همه پیام‌ها واقعاً از API جعلی حذف شده باشند
+        while any(fake.chats.get(chat_id) for chat_id in expiry_chats) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - started
+        # پیام‌های باقی‌مانده پس از مهلت به عنوان خطا گزارش می‌شوند
+        leftover = sum(len(fake.chats.get(chat_id, {})) for chat_id in expiry_chats)
+        if leftover:
+            botmod.logger.warning(f"[timer_expiry] {leftover} پیام پس از {args.expiry_timeout} ثانیه حذف نشد")
+        results.append({
+            'scenario': 'timer_expiry',
+            'operations': args.expiries,
+            'concurrency': botmod.DELETE_CONCURRENCY,
+            'errors': leftover,
+            'seconds': round(elapsed, 3),
+            'throughput': round(args.expiries / elapsed, 2) if elapsed else 0.0,
+            'p50_ms': None,
+            'p99_ms': None,
+        })
+    finally:
+        await botmod.bot_manager.close()
+        await bot.shutdown()
+        await botmod.http_layer.close()
+        await runner.cleanup()
+
+    results.append({'scenario': 'fake_api', 'calls': fake.calls, 'flood_events': fake.flood_events})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark against a fake Telegram Bot API")
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--operations', type=int, default=500, help="number of get_category calls")
+    parser.add_argument('--categories', type=int, default=30)
+    parser.add_argument('--files-per-category', type=int, default=20)
+    parser.add_argument('--deliveries', type=int, default=100)
+    parser.add_argument('--uploads', type=int, default=10)
+    parser.add_argument('--expiries', type=int, default=200)
+    parser.add_argument('--expiry-timeout', type=float, default=60.0, help="seconds to wait for expired messages to be deleted")
+    parser.add_argument('--latency', type=float, default=0.03, help="mean simulated API latency in seconds")
+    parser.add_argument('--flood-chat-rate', type=float, default=20.0, help="allowed sends per second per chat")
+    parser.add_argument('--flood-global-rate', type=float, default=30.0, help="allowed sends per second overall")
+    parser.add_argument('--output', help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmarks(args))
+
+    for row in results:
+        if 'throughput' in row:
+            print(
+                f"{row['scenario']:<24} ops={row['operations']:<6} errors={row['errors']:<4} "
+                f"{row['throughput']:>9} ops/s  p50={row['p50_ms']} ms  p99={row['p99_ms']} ms"
+            )
+        else:
+            print(f"{row['scenario']:<24} {json.dumps(row, ensure_ascii=False)}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())